@@ -0,0 +1,192 @@
+"""Checks and measures cert_util token verification against a local cert server.
+
+The stand-in cert server serves the certificates of locally generated
+keys, with a configurable Cache-Control header, and counts its fetches.
+Checks the max-age parsing, that a rotated key is refetched once
+MIN_REFETCH_INTERVAL_SECONDS passed but unknown kids aren't refetched
+more often, and the accepted clock skew, then times verifying tokens with cold certs, cached certs
+and remembered tokens. Exits with an error if a check fails:
+
+    python benchmarks/cert_cache_benchmark.py --tokens 200
+"""
+
+import argparse
+import datetime
+import json
+import os
+import statistics
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from cryptography import x509
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
+from cryptography.x509.oid import NameOID
+from google.auth import crypt, jwt
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "cloud_function"))
+
+import cert_util
+
+AUDIENCE = "benchmark-audience"
+
+
+def make_key(kid):
+    """Returns (signer, certificate PEM) of a new key with kid."""
+
+    key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, kid)])
+    cert = (x509.CertificateBuilder().subject_name(name).issuer_name(name)
+            .public_key(key.public_key()).serial_number(1)
+            .not_valid_before(datetime.datetime(2020, 1, 1))
+            .not_valid_after(datetime.datetime(2040, 1, 1))
+            .sign(key, hashes.SHA256()))
+
+    private_key = key.private_bytes(serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8,
+                                    serialization.NoEncryption()).decode()
+    signer = crypt.RSASigner.from_string(private_key, key_id=kid)
+    return signer, cert.public_bytes(serialization.Encoding.PEM).decode()
+
+
+class FakeCertServer:
+    """Serves the certificates of its keys, like a token issuer's cert url."""
+
+    def __init__(self, cache_control="public, max-age=3600"):
+        self.cache_control = cache_control
+        self.certs = {}
+        self.signers = {}
+        self.fetches = 0
+        self.lock = threading.Lock()
+
+    def add_key(self, kid):
+        self.signers[kid], self.certs[kid] = make_key(kid)
+
+    def token(self, kid, issued_in=0):
+        """Returns a token signed with kid, issued issued_in seconds from now."""
+
+        now = int(time.time()) + issued_in
+        claims = {"iss": "benchmark", "aud": AUDIENCE, "iat": now, "exp": now + 600}
+        return jwt.encode(self.signers[kid], claims).decode()
+
+    def start(self):
+        """Starts serving on a local port, returns the cert url."""
+
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                with fake.lock:
+                    fake.fetches += 1
+                body = json.dumps(fake.certs).encode()
+
+                self.send_response(200)
+                if fake.cache_control:
+                    self.send_header("Cache-Control", fake.cache_control)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.server = server
+        return f"http://127.0.0.1:{server.server_address[1]}/"
+
+
+def check(name, passed):
+    print(f"{'ok' if passed else 'FAILED':>6}  {name}")
+    if not passed:
+        check.failed = True
+
+check.failed = False
+
+
+def verifies(token, cert_cache):
+    try:
+        cert_util.verify_token(token, cert_cache, AUDIENCE)
+        return True
+    except ValueError:
+        return False
+
+
+def run_checks(refetch_interval):
+    cert_util.MIN_REFETCH_INTERVAL_SECONDS = refetch_interval
+
+    for cache_control, max_age in [("public, max-age=120", 120), ("no-cache", cert_util.DEFAULT_MAX_AGE_SECONDS),
+                                   (None, cert_util.DEFAULT_MAX_AGE_SECONDS)]:
+        fake = FakeCertServer(cache_control)
+        fake.add_key("key-1")
+        cert_cache = cert_util.CertCache(fake.start())
+        cert_cache.get_cert("key-1")
+        check(f"max-age of {cache_control!r} is {max_age}s",
+              round(cert_cache._expires_at - cert_cache._fetched_at) == max_age)
+
+    fake = FakeCertServer()
+    fake.add_key("key-1")
+    cert_cache = cert_util.CertCache(fake.start())
+
+    check("token verifies, certs fetched once", verifies(fake.token("key-1"), cert_cache) and fake.fetches == 1)
+    check("next token uses the cached certs", verifies(fake.token("key-1", 1), cert_cache) and fake.fetches == 1)
+
+    fake.add_key("key-2")
+    check("rotated key isn't refetched within the refetch interval",
+          not verifies(fake.token("key-2"), cert_cache) and fake.fetches == 1)
+
+    time.sleep(refetch_interval + 0.1)
+    check("rotated key is refetched after the refetch interval",
+          verifies(fake.token("key-2", 2), cert_cache) and fake.fetches == 2)
+    unknown_signer, _ = make_key("key-3")
+    unknown_tokens = [jwt.encode(unknown_signer, {"aud": AUDIENCE, "n": i}).decode() for i in range(3)]
+    check("tokens of an unknown kid don't refetch again within the interval",
+          not any(verifies(token, cert_cache) for token in unknown_tokens) and fake.fetches == 2)
+
+    skew = cert_util.CLOCK_SKEW_SECONDS
+    check(f"token issued {skew // 2}s ahead of the clock verifies",
+          verifies(fake.token("key-1", skew // 2), cert_cache))
+    check(f"token issued {skew * 2}s ahead of the clock is rejected",
+          not verifies(fake.token("key-1", skew * 2), cert_cache))
+
+
+def time_verify(name, tokens, cert_cache_for):
+    latencies = []
+    for token in tokens:
+        cert_cache = cert_cache_for()
+        start = time.perf_counter()
+        cert_util.verify_token(token, cert_cache, AUDIENCE)
+        latencies.append(time.perf_counter() - start)
+
+    print(f"{name:>18}: median {statistics.median(latencies) * 1000:7.3f} ms, "
+          f"max {max(latencies) * 1000:7.3f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--tokens", type=int, default=200)
+    parser.add_argument("--refetch-interval-s", type=float, default=0.5,
+                        help="MIN_REFETCH_INTERVAL_SECONDS during the checks")
+    args = parser.parse_args()
+
+    run_checks(args.refetch_interval_s)
+    if check.failed:
+        sys.exit("\nsome checks failed")
+
+    fake = FakeCertServer()
+    fake.add_key("key-1")
+    cert_url = fake.start()
+    tokens = [fake.token("key-1", i) for i in range(args.tokens)]
+
+    print()
+    cert_util.verified_tokens.clear()
+    time_verify("cold certs", tokens, lambda: cert_util.CertCache(cert_url))
+    cert_util.verified_tokens.clear()
+    shared = cert_util.CertCache(cert_url)
+    time_verify("cached certs", tokens, lambda: shared)
+    time_verify("remembered token", tokens, lambda: shared)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,101 @@
+"""Profiles the imports of the Cloud Function entry point at cold start.
+
+Imports main in fresh interpreters with python -X importtime and reports
+the median total, the modules main imports directly and the heaviest
+packages overall. Fails if a module that should only be loaded on first
+use (see LAZY_MODULES) is imported at load, or if the total exceeds
+--max-ms, so cold start regressions show up:
+
+    python benchmarks/import_time_benchmark.py --runs 5 --max-ms 1500
+"""
+
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+from collections import defaultdict
+
+CLOUD_FUNCTION_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "cloud_function")
+
+# Modules only some events need, which main must not import at load.
+LAZY_MODULES = [
+    "google.cloud.logging",
+    "google.cloud.tasks_v2",
+    "googleapiclient.discovery",
+    "oauth2client",
+    "vector_index",
+]
+
+
+def profile_imports():
+    """Imports main in a new interpreter, returns [(cumulative_us, depth, module)]."""
+
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", "import main"],
+                            cwd=CLOUD_FUNCTION_DIR, capture_output=True, text=True)
+    if result.returncode != 0:
+        sys.exit(f"importing main failed:\n{result.stderr[-2000:]}")
+
+    imports = []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+
+        _, cumulative, name = line.split("|")
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        imports.append((int(cumulative), depth, name.strip()))
+
+    return imports
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--top", type=int, default=10)
+    parser.add_argument("--max-ms", type=float, default=None)
+    args = parser.parse_args()
+
+    totals = []
+    direct = defaultdict(list)
+    packages = defaultdict(list)
+
+    for _ in range(args.runs):
+        imports = profile_imports()
+        totals.append(next(cumulative for cumulative, depth, name in imports if name == "main") / 1000)
+
+        # importtime lists the modules an import pulls in right before it
+        children = []
+        for cumulative, depth, name in imports:
+            if depth == 1:
+                children.append((name, cumulative / 1000))
+            elif depth == 0:
+                if name == "main":
+                    for child, milliseconds in children:
+                        direct[child].append(milliseconds)
+                children = []
+
+            if "." not in name:
+                packages[name].append(cumulative / 1000)
+
+    total = statistics.median(totals)
+    print(f"import main: {total:.0f} ms (median of {args.runs}, min {min(totals):.0f}, max {max(totals):.0f})")
+
+    print("\nimported directly by main:")
+    for name, times in sorted(direct.items(), key=lambda item: -statistics.median(item[1]))[:args.top]:
+        print(f"  {statistics.median(times):8.1f} ms  {name}")
+
+    print("\nheaviest top level modules:")
+    for name, times in sorted(packages.items(), key=lambda item: -max(item[1]))[:args.top]:
+        print(f"  {max(times):8.1f} ms  {name}")
+
+    loaded = {name for cumulative, depth, name in imports}
+    eager = [name for name in LAZY_MODULES if name in loaded]
+    if eager:
+        sys.exit(f"\nloaded at import, should be lazy: {', '.join(eager)}")
+
+    if args.max_ms is not None and total > args.max_ms:
+        sys.exit(f"\nimport main took {total:.0f} ms, more than --max-ms {args.max_ms:.0f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,205 @@
+"""Measures gpt_util against a local fake OpenAI server injecting errors and latency.
+
+The fake server answers chat completions after --latency-ms, or after
+--tail-ms for --tail-rate of them, and fails --error-rate of them, half
+with 429 and a Retry-After of --retry-after-s, half with 500. Compares a
+single attempt, retries with backoff (retry_util) and retries with hedged
+requests, each call within a deadline of --deadline-s like a Chat reply.
+Then the server fails every request, to compare calls with and without
+the circuit breaker:
+
+    python benchmarks/openai_resilience_benchmark.py --calls 200 --error-rate 0.1 --tail-rate 0.05
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import statistics
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import openai
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "cloud_function"))
+
+import async_util
+import deadline_util
+import gpt_util
+import retry_util
+
+COMPLETION = json.dumps({
+    "id": "chatcmpl-benchmark",
+    "object": "chat.completion",
+    "model": "gpt-3.5-turbo",
+    "choices": [{"index": 0, "message": {"role": "assistant", "content": "ok"}, "finish_reason": "stop"}],
+    "usage": {"prompt_tokens": 1, "completion_tokens": 1, "total_tokens": 2},
+}).encode()
+
+
+class FakeOpenAIServer:
+    """Answers chat completions, failing and delaying some of them.
+
+    Errors of requests the client hung up on, like hedged requests it no
+    longer needed, are ignored.
+    """
+
+    def __init__(self, latency, tail_latency, tail_rate, error_rate, retry_after):
+        self.latency = latency
+        self.tail_latency = tail_latency
+        self.tail_rate = tail_rate
+        self.error_rate = error_rate
+        self.retry_after = retry_after
+        self.requests = 0
+        self.lock = threading.Lock()
+
+    def start(self):
+        """Starts serving on a local port, returns the api_base to use."""
+
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            disable_nagle_algorithm = True
+
+            def do_POST(self):
+                self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                status, headers, body = fake.respond()
+
+                self.send_response(status)
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        class Server(ThreadingHTTPServer):
+            daemon_threads = True
+
+            def handle_error(self, request, client_address):
+                pass
+
+        server = Server(("127.0.0.1", 0), Handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.server = server
+        return f"http://127.0.0.1:{server.server_address[1]}/v1"
+
+    def respond(self):
+        with self.lock:
+            self.requests += 1
+
+        slow = random.random() < self.tail_rate
+        time.sleep(self.tail_latency if slow else self.latency)
+
+        if random.random() < self.error_rate:
+            if random.random() < 0.5:
+                error = {"error": {"message": "Rate limit reached", "type": "requests"}}
+                return 429, {"Retry-After": str(self.retry_after)}, json.dumps(error).encode()
+
+            error = {"error": {"message": "The server had an error", "type": "server_error"}}
+            return 500, {}, json.dumps(error).encode()
+
+        return 200, {}, COMPLETION
+
+
+async def timed_call(deadline_seconds, api_key):
+    """Returns (outcome, seconds) of one chat completion within a deadline."""
+
+    start = time.perf_counter()
+    with deadline_util.deadline(deadline_seconds):
+        try:
+            await gpt_util.get_gpt_response_async([{"role": "user", "content": "hi"}], api_key)
+            outcome = "ok"
+        except deadline_util.DeadlineExceeded:
+            outcome = "deadline"
+        except retry_util.CircuitOpenError:
+            outcome = "circuit_open"
+        except openai.error.OpenAIError:
+            outcome = "error"
+
+    return outcome, time.perf_counter() - start
+
+
+async def run_calls(calls, concurrency, deadline_seconds, api_key):
+    limit = asyncio.Semaphore(concurrency)
+
+    async def limited():
+        async with limit:
+            return await timed_call(deadline_seconds, api_key)
+
+    return await asyncio.gather(*[limited() for _ in range(calls)])
+
+
+def run(name, fake, args, api_key="sk-benchmark", calls=None, concurrency=None):
+    retry_util.breakers.clear()
+    requests_before = fake.requests
+
+    start = time.perf_counter()
+    results = async_util.run(run_calls(calls or args.calls, concurrency or args.concurrency,
+                                       args.deadline_s, api_key))
+    elapsed = time.perf_counter() - start
+
+    outcomes = {}
+    for outcome, seconds in results:
+        outcomes[outcome] = outcomes.get(outcome, 0) + 1
+
+    latencies = sorted(seconds for outcome, seconds in results)
+    p99 = latencies[max(int(len(latencies) * 0.99) - 1, 0)]
+    p95 = latencies[max(int(len(latencies) * 0.95) - 1, 0)]
+    print(f"{name:>22}: {outcomes}, median {statistics.median(latencies) * 1000:6.0f} ms, "
+          f"p95 {p95 * 1000:6.0f} ms, p99 {p99 * 1000:6.0f} ms, "
+          f"{fake.requests - requests_before} requests in {elapsed:.1f}s")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--calls", type=int, default=200)
+    # at most http_util.POOL_MAXSIZE, or calls also wait for a connection
+    parser.add_argument("--concurrency", type=int, default=5)
+    parser.add_argument("--latency-ms", type=float, default=50)
+    parser.add_argument("--tail-ms", type=float, default=3000)
+    parser.add_argument("--tail-rate", type=float, default=0.05)
+    parser.add_argument("--error-rate", type=float, default=0.1)
+    parser.add_argument("--retry-after-s", type=float, default=0.2)
+    parser.add_argument("--hedge-after-ms", type=float, default=300)
+    parser.add_argument("--deadline-s", type=float, default=5)
+    args = parser.parse_args()
+
+    fake = FakeOpenAIServer(args.latency_ms / 1000, args.tail_ms / 1000, args.tail_rate,
+                            args.error_rate, args.retry_after_s)
+    openai.api_base = fake.start()
+
+    # failures are spread over many calls here, the breaker is measured below
+    failure_threshold = retry_util.FAILURE_THRESHOLD
+    retry_util.FAILURE_THRESHOLD = args.calls * 10
+
+    max_attempts = retry_util.MAX_ATTEMPTS
+    retry_util.MAX_ATTEMPTS = 1
+    gpt_util.HEDGE_AFTER_SECONDS = None
+    run("warm up", fake, args, calls=args.concurrency)
+    run("single attempt", fake, args)
+
+    retry_util.MAX_ATTEMPTS = max_attempts
+    run("retries", fake, args)
+
+    gpt_util.HEDGE_AFTER_SECONDS = args.hedge_after_ms / 1000
+    run("retries + hedging", fake, args)
+
+    # OpenAI is down: every call fails, one at a time
+    fake.error_rate = 1
+    fake.tail_rate = 0
+    run("outage, no breaker", fake, args, concurrency=1, calls=args.calls // 10)
+
+    retry_util.FAILURE_THRESHOLD = failure_threshold
+    run("outage, breaker", fake, args, concurrency=1, calls=args.calls // 10)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,99 @@
+"""Measures semantic cache lookups and hit rate, offline.
+
+Questions are embedded with a fake embedding function, a bag of hashed
+words, so no OpenAI API key is needed. Each question is random words and
+its paraphrase reverses them and adds one, so it's close to its question
+but not to the others. The default threshold is lower than the cache's,
+since paraphrases of real embeddings are closer than these.
+
+    python benchmarks/semantic_cache_benchmark.py --entries 1000 --dimensions 1536
+"""
+
+import argparse
+import asyncio
+import os
+import sys
+import tempfile
+import time
+import zlib
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "cloud_function"))
+
+import metrics_util
+import semantic_cache_util
+from vector_index import VectorIndex
+
+
+def fake_embedding_function(dimensions):
+    async def embed(text, api_key=None):
+        vector = np.zeros(dimensions, dtype=np.float32)
+        for word in text.lower().split():
+            vector[zlib.crc32(word.encode("utf-8")) % dimensions] += 1
+        return vector
+
+    return embed
+
+
+def make_questions(count, words_per_question=10, vocabulary=5000, seed=0):
+    """Returns count questions of random words and a paraphrase of each."""
+
+    random = np.random.default_rng(seed)
+    questions, paraphrases = [], []
+    for i in range(count):
+        words = [f"w{n}" for n in random.choice(vocabulary, words_per_question, replace=False)]
+        questions.append(" ".join(words))
+        paraphrases.append("please " + " ".join(reversed(words)))
+
+    return questions, paraphrases
+
+
+async def run(entries, dimensions, threshold):
+    path = os.path.join(tempfile.mkdtemp(), "semantic_cache.npz")
+    cache = semantic_cache_util.SemanticCache(fake_embedding_function(dimensions), threshold, entries, path)
+
+    questions, paraphrases = make_questions(entries)
+
+    start = time.perf_counter()
+    for i in range(entries):
+        response, embedding = await cache.lookup(questions[i])
+        cache.store(embedding, f"answer {i}")
+    elapsed = time.perf_counter() - start
+    print(f"fill: {entries} lookups + stores in {elapsed:.2f}s, {elapsed / entries * 1000:.2f} ms each")
+
+    correct = 0
+    start = time.perf_counter()
+    for i in range(entries):
+        response, embedding = await cache.lookup(paraphrases[i])
+        correct += response == f"answer {i}"
+    elapsed = time.perf_counter() - start
+    print(f"paraphrases: {correct}/{entries} correct hits, {elapsed / entries * 1000:.2f} ms per lookup")
+
+    cache.index.save(path)
+    start = time.perf_counter()
+    loaded = VectorIndex.load(path, entries)
+    print(f"load: {len(loaded)} entries, {os.path.getsize(path) / 1024:.0f} KB "
+          f"in {(time.perf_counter() - start) * 1000:.1f} ms")
+
+    # a full index evicts its least recently used entry for a new one
+    response, embedding = await cache.lookup("what is the capital of France")
+    cache.store(embedding, "Paris")
+    response, embedding = await cache.lookup("what is the capital of France")
+    print(f"after eviction: {len(cache.index)} entries, new entry found: {response == 'Paris'}")
+
+    print({name: metrics_util.get_counter(name) for name in ("semantic_cache.hit", "semantic_cache.miss")})
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--entries", type=int, default=1000)
+    parser.add_argument("--dimensions", type=int, default=1536)
+    parser.add_argument("--threshold", type=float, default=0.9)
+    args = parser.parse_args()
+
+    asyncio.run(run(args.entries, args.dimensions, args.threshold))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,221 @@
+"""Checks and measures streamed replies against a local fake OpenAI and Chat API.
+
+The stand-in server streams chat completions word by word, one every
+--word-ms, and records the messages created and edited through the Chat
+REST API. Datastore is replaced by an in-memory thread store. A message
+event is handled like handle_chat() does, within a deadline of
+--deadline-s, with a stream longer than that. Checks that the event is
+answered before the deadline without starting reply_in_background(), and
+that once the response is closed the placeholder gets the full text and
+the turn is stored once. Exits with an error if a check fails:
+
+    python benchmarks/stream_reply_benchmark.py --words 30 --word-ms 100 --deadline-s 1.5
+"""
+
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import flask
+import openai
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "cloud_function"))
+
+import async_util
+import datastore_util
+import deadline_util
+import deferred_util
+import main
+import story_util
+
+class FakeServer:
+    """Streams chat completions and stores the messages sent to Chat."""
+
+    def __init__(self, words, word_seconds):
+        self.words = words
+        self.word_seconds = word_seconds
+        self.messages = {}
+        self.creates = 0
+        self.edits = 0
+        self.lock = threading.Lock()
+
+    def text(self):
+        return "".join(f"w{i} " for i in range(self.words))
+
+    def start(self):
+        """Starts serving on a local port, returns its url."""
+
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_POST(self):
+                body = self.read_body()
+                if self.path.startswith("/v1/chat/completions"):
+                    self.stream_completion()
+                    return
+
+                with fake.lock:
+                    fake.creates += 1
+                    name = f"{self.path[len('/chat/'):-len('/messages')]}/messages/{fake.creates}"
+                    fake.messages[name] = body["text"]
+                self.send_json({"name": name})
+
+            def do_PUT(self):
+                body = self.read_body()
+                name = self.path.split("?")[0][len("/chat/"):]
+                with fake.lock:
+                    fake.edits += 1
+                    fake.messages[name] = body["text"]
+                self.send_json({"name": name})
+
+            def read_body(self):
+                return json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+
+            def send_json(self, obj):
+                body = json.dumps(obj).encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def stream_completion(self):
+                self.send_response(200)
+                self.send_header("Content-Type", "text/event-stream")
+                self.send_header("Connection", "close")
+                self.end_headers()
+
+                for i in range(fake.words):
+                    time.sleep(fake.word_seconds)
+                    chunk = {"id": "chatcmpl-benchmark", "object": "chat.completion.chunk", "model": "gpt-3.5-turbo",
+                             "choices": [{"index": 0, "delta": {"content": f"w{i} "}, "finish_reason": None}]}
+                    self.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode())
+                    self.wfile.flush()
+
+                self.wfile.write(b"data: [DONE]\n\n")
+                self.close_connection = True
+
+            def log_message(self, *args):
+                pass
+
+        class Server(ThreadingHTTPServer):
+            daemon_threads = True
+
+        server = Server(("127.0.0.1", 0), Handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.server = server
+        return f"http://127.0.0.1:{server.server_address[1]}"
+
+
+class FakeCredentials:
+    valid = True
+    token = "benchmark-token"
+
+
+class FakeThreadStore:
+    """Stands in for the datastore_util functions a chat message uses."""
+
+    def __init__(self):
+        self.turns = []
+        self.writes = 0
+
+    def install(self):
+        datastore_util.get_api_key_and_thread = lambda user_id, thread_id: ("sk-benchmark", None)
+        datastore_util.start_conversation = self.start_conversation
+        datastore_util.append_messages = self.append_messages
+
+    def start_conversation(self, thread_id, system_messages, messages, thread_obj=None):
+        self.turns = []
+        self.append_messages(thread_id, messages)
+
+    def append_messages(self, thread_id, messages, thread_obj=None):
+        self.writes += 1
+        self.turns.extend(messages)
+
+
+def check(name, passed):
+    print(f"{'ok' if passed else 'FAILED':>6}  {name}")
+    if not passed:
+        check.failed = True
+
+check.failed = False
+
+
+def message_event(text):
+    return {
+        "type": "MESSAGE",
+        "message": {"argumentText": text},
+        "user": {"name": "users/benchmark"},
+        "space": {"name": "spaces/space", "spaceType": "DIRECT_MESSAGE"},
+    }
+
+
+def run_benchmark():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--words", type=int, default=30)
+    parser.add_argument("--word-ms", type=float, default=100)
+    parser.add_argument("--deadline-s", type=float, default=1.5)
+    args = parser.parse_args()
+
+    fake = FakeServer(args.words, args.word_ms / 1000)
+    url = fake.start()
+    openai.api_base = f"{url}/v1"
+    story_util.CHAT_API_URL = f"{url}/chat"
+    story_util.get_chat_credentials = lambda: FakeCredentials()
+
+    store = FakeThreadStore()
+    store.install()
+
+    # records the fallback instead of enqueueing a task
+    fallbacks = []
+
+    async def recorded_reply_in_background(*args):
+        fallbacks.append(args)
+        return {}
+
+    main.reply_in_background = recorded_reply_in_background
+    main.STREAM_RESPONSES = True
+
+    # the deadline's budgets, scaled down like the deadline
+    scale = args.deadline_s / main.RESPONSE_DEADLINE_SECONDS
+    main.MIN_SYNC_BUDGET_SECONDS *= scale
+    reserve = main.FALLBACK_RESERVE_SECONDS * scale
+
+    # like handle_chat(), without verifying the request or an ndb context
+    @deferred_util.with_deferred_calls
+    def handle(event_data):
+        with deadline_util.deadline(args.deadline_s, reserve):
+            return async_util.run(main.process_message_event(event_data))
+
+    app = flask.Flask(__name__)
+    start = time.perf_counter()
+    with app.test_request_context():
+        response = handle(message_event("hi"))
+        answered = time.perf_counter() - start
+
+        # runs the deferred calls, like the server does once the response is sent
+        response.close()
+        streamed = time.perf_counter() - start
+
+    print(f"answered in {answered:.2f}s, streamed {args.words} words in {streamed:.2f}s, "
+          f"{fake.edits} edits\n")
+
+    check(f"event answered before the {args.deadline_s}s deadline", answered < args.deadline_s)
+    check("answer is empty, the reply is the placeholder", response.get_json() == {})
+    check("reply_in_background not started", not fallbacks)
+    check("one message sent", fake.creates == 1)
+    check("placeholder has the full text", list(fake.messages.values()) == [fake.text()])
+    check("turn stored once", store.writes == 1 and store.turns[-1]["content"] == fake.text())
+
+    if check.failed:
+        sys.exit("\nsome checks failed")
+
+
+if __name__ == "__main__":
+    run_benchmark()
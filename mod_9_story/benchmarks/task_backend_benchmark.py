@@ -0,0 +1,179 @@
+"""Compares the Cloud Tasks and in-process task backends of task_util.
+
+Measures how long it takes from run_as_background_task() until the action
+starts running. With Cloud Tasks, a local fake Tasks server delivers each
+task back to handle_chat over HTTP after --queue-delay-ms, with an OIDC
+token signed by a local key, so the extra request and its verification
+are included. The in-process backend runs the action on a worker thread.
+Actions are replaced by a recorder and API keys come from the cache, so
+no OpenAI, Chat API or Datastore calls are made:
+
+    python benchmarks/task_backend_benchmark.py --tasks 50 --queue-delay-ms 20
+"""
+
+import argparse
+import datetime
+import json
+import os
+import statistics
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import flask
+import requests
+from cryptography import x509
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
+from cryptography.x509.oid import NameOID
+from google.auth import crypt, jwt
+from google.cloud import tasks_v2
+from werkzeug.serving import make_server
+
+sys.path.insert(0, os.path.dirname(__file__))
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "cloud_function"))
+
+# the ndb client is created for the actions' context, but never called
+os.environ.setdefault("DATASTORE_EMULATOR_HOST", "localhost:8081")
+os.environ.setdefault("GOOGLE_CLOUD_PROJECT", "benchmark")
+
+import main
+import auth_util
+import cert_util
+import datastore_util
+import task_util
+from tasks_enqueue_benchmark import FakeTasksServer
+
+
+class TokenSigner:
+    """Signs OIDC tokens like Cloud Tasks, and serves the certificate to verify them."""
+
+    def __init__(self):
+        key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+        name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, "benchmark")])
+        cert = (x509.CertificateBuilder().subject_name(name).issuer_name(name)
+                .public_key(key.public_key()).serial_number(1)
+                .not_valid_before(datetime.datetime(2020, 1, 1))
+                .not_valid_after(datetime.datetime(2040, 1, 1))
+                .sign(key, hashes.SHA256()))
+
+        private_key = key.private_bytes(serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8,
+                                        serialization.NoEncryption()).decode()
+        self.signer = crypt.RSASigner.from_string(private_key, key_id="benchmark")
+        certs = json.dumps({"benchmark": cert.public_bytes(serialization.Encoding.PEM).decode()}).encode()
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                self.send_response(200)
+                self.send_header("Cache-Control", "public, max-age=3600")
+                self.send_header("Content-Length", str(len(certs)))
+                self.end_headers()
+                self.wfile.write(certs)
+
+            def log_message(self, *args):
+                pass
+
+        server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.certs_url = f"http://127.0.0.1:{server.server_address[1]}/"
+
+    def token(self, audience):
+        now = int(time.time())
+        claims = {"iss": auth_util.TASK_ISSUER, "aud": audience, "iat": now, "exp": now + 600}
+        return jwt.encode(self.signer, claims).decode()
+
+
+class Recorder:
+    """Stands in for an action, records when each task started."""
+
+    def __init__(self):
+        self.started = {}
+        self.lock = threading.Lock()
+        self.done = threading.Condition(self.lock)
+
+    def __call__(self, thread_id, user_text, message_id_to_update, api_key=None):
+        with self.lock:
+            self.started[user_text] = time.perf_counter()
+            self.done.notify_all()
+
+    def wait_for(self, count, timeout=60):
+        with self.lock:
+            if not self.done.wait_for(lambda: len(self.started) >= count, timeout):
+                sys.exit(f"only {len(self.started)} of {count} tasks ran")
+
+
+def start_handle_chat():
+    """Serves main.handle_chat locally, returns its url."""
+
+    app = flask.Flask("benchmark")
+    app.add_url_rule("/", "handle_chat", lambda: main.handle_chat(flask.request), methods=["POST"])
+
+    server = make_server("127.0.0.1", 0, app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return f"http://127.0.0.1:{server.server_port}/"
+
+
+def run(name, tasks, recorder):
+    recorder.started.clear()
+
+    enqueue_times = {}
+    enqueue_latencies = []
+    start = time.perf_counter()
+    for i in range(tasks):
+        user_text = f"{name} {i}"
+        enqueue_times[user_text] = time.perf_counter()
+        task_util.run_as_background_task("process_story_message", "user-space", user_text, None)
+        enqueue_latencies.append(time.perf_counter() - enqueue_times[user_text])
+
+    recorder.wait_for(tasks)
+    elapsed = time.perf_counter() - start
+
+    delays = sorted(recorder.started[user_text] - enqueued for user_text, enqueued in enqueue_times.items())
+    p95 = delays[max(int(len(delays) * 0.95) - 1, 0)]
+    print(f"{name:>12}: enqueue median {statistics.median(enqueue_latencies) * 1000:6.2f} ms, "
+          f"until start median {statistics.median(delays) * 1000:6.1f} ms, p95 {p95 * 1000:6.1f} ms, "
+          f"{tasks} tasks done in {elapsed * 1000:.0f} ms")
+
+
+def main_benchmark():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--tasks", type=int, default=50)
+    parser.add_argument("--queue-delay-ms", type=float, default=20,
+                        help="delay of the fake queue before it delivers a task")
+    args = parser.parse_args()
+
+    recorder = Recorder()
+    task_util.actions.routes["process_story_message"].handler = recorder
+    datastore_util.get_api_key = lambda user_id: "sk-benchmark"
+
+    signer = TokenSigner()
+    cert_util.cert_caches[auth_util.TASK_CERTS_URL] = cert_util.CertCache(signer.certs_url)
+    handle_chat_url = start_handle_chat()
+
+    session = requests.Session()
+    delivery_executor = ThreadPoolExecutor(max_workers=16)
+
+    def deliver(task):
+        time.sleep(args.queue_delay_ms / 1000)
+        headers = dict(task.http_request.headers)
+        headers["Authorization"] = "Bearer " + signer.token(task.http_request.oidc_token.audience)
+        session.post(handle_chat_url, data=task.http_request.body, headers=headers)
+
+    fake = FakeTasksServer(0, dispatch=lambda task: delivery_executor.submit(deliver, task))
+    tasks_v2.CloudTasksClient = fake.start_grpc()
+
+    task_util.TASK_BACKEND = "cloud_tasks"
+    task_util.task_backend = None
+    run("warm up", 1, recorder)
+    run("cloud_tasks", args.tasks, recorder)
+
+    task_util.TASK_BACKEND = "in_process"
+    task_util.task_backend = None
+    run("warm up", 1, recorder)
+    run("in_process", args.tasks, recorder)
+
+
+if __name__ == "__main__":
+    main_benchmark()
@@ -0,0 +1,174 @@
+"""Measures Cloud Tasks enqueue latency against a local fake Tasks server.
+
+Compares creating a client for every task (cold, as task_util did
+before it kept one client per instance), reusing one client (warm), and
+enqueueing a batch with task_util.run_as_background_tasks(). The fake
+server answers CreateTask after --latency-ms, over gRPC like the real
+client does by default, or over REST with --transport rest:
+
+    python benchmarks/tasks_enqueue_benchmark.py --tasks 50 --latency-ms 20
+
+Cold numbers leave out credential discovery, the fake server needs none.
+"""
+
+import argparse
+import json
+import os
+import statistics
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import grpc
+from google.api_core.client_options import ClientOptions
+from google.auth.credentials import AnonymousCredentials
+from google.cloud import tasks_v2
+from google.cloud.tasks_v2 import CloudTasksClient
+from google.cloud.tasks_v2.services.cloud_tasks.transports import CloudTasksGrpcTransport
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "cloud_function"))
+
+# task_util and auth_util import each other, main imports them in order
+import main
+import task_util
+
+
+class FakeTasksServer:
+    """Counts created tasks and answers each after latency seconds.
+
+    If dispatch is set, it's called with every task created over gRPC,
+    to deliver it like Cloud Tasks would.
+    """
+
+    def __init__(self, latency, dispatch=None):
+        self.latency = latency
+        self.dispatch = dispatch
+        self.created = 0
+        self.lock = threading.Lock()
+
+    def create_task(self, parent, task=None):
+        time.sleep(self.latency)
+        with self.lock:
+            self.created += 1
+            name = f"{parent}/tasks/{self.created}"
+
+        if self.dispatch and task is not None:
+            self.dispatch(task)
+
+        return name
+
+    def start_grpc(self):
+        def create_task(request, context):
+            return tasks_v2.Task(name=self.create_task(request.parent, request.task))
+
+        handler = grpc.method_handlers_generic_handler("google.cloud.tasks.v2.CloudTasks", {
+            "CreateTask": grpc.unary_unary_rpc_method_handler(
+                create_task,
+                request_deserializer=tasks_v2.CreateTaskRequest.deserialize,
+                response_serializer=tasks_v2.Task.serialize),
+        })
+
+        # kept on self, the server stops once it's garbage collected
+        self.server = grpc.server(ThreadPoolExecutor(max_workers=32))
+        self.server.add_generic_rpc_handlers((handler,))
+        port = self.server.add_insecure_port("127.0.0.1:0")
+        self.server.start()
+
+        def make_client():
+            channel = grpc.insecure_channel(f"127.0.0.1:{port}")
+            return CloudTasksClient(transport=CloudTasksGrpcTransport(channel=channel))
+
+        return make_client
+
+    def start_rest(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            # kept-alive connections would otherwise wait on delayed ACKs
+            disable_nagle_algorithm = True
+
+            def do_POST(self):
+                self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                parent = self.path.split("/v2/")[1].rsplit("/tasks", 1)[0]
+                body = json.dumps({"name": fake.create_task(parent)}).encode()
+
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        endpoint = f"http://127.0.0.1:{server.server_address[1]}"
+
+        def make_client():
+            return CloudTasksClient(transport="rest", credentials=AnonymousCredentials(),
+                                             client_options=ClientOptions(api_endpoint=endpoint))
+
+        return make_client
+
+
+def task(i):
+    return ("process_story_message", f"user-space{i}", f"chapter {i}", None)
+
+
+def report(name, latencies, elapsed):
+    latencies = sorted(latencies)
+    p95 = latencies[int(len(latencies) * 0.95) - 1] if len(latencies) > 1 else latencies[0]
+    print(f"{name:>8}: {len(latencies)} tasks in {elapsed * 1000:7.1f} ms, "
+          f"median {statistics.median(latencies) * 1000:6.1f} ms, p95 {p95 * 1000:6.1f} ms per enqueue")
+
+
+def timed_enqueue(i):
+    start = time.perf_counter()
+    task_util.run_as_background_task(*task(i))
+    return time.perf_counter() - start
+
+
+def main_benchmark():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--tasks", type=int, default=50)
+    parser.add_argument("--latency-ms", type=float, default=20)
+    parser.add_argument("--transport", choices=["grpc", "rest"], default="grpc")
+    args = parser.parse_args()
+
+    fake = FakeTasksServer(args.latency_ms / 1000)
+    make_client = fake.start_grpc() if args.transport == "grpc" else fake.start_rest()
+
+    # get_tasks_client() creates its client with tasks_v2.CloudTasksClient()
+    tasks_v2.CloudTasksClient = make_client
+
+    # cold: a new client for every task
+    latencies = []
+    start = time.perf_counter()
+    for i in range(args.tasks):
+        task_util.tasks_client = None
+        latencies.append(timed_enqueue(i))
+    report("cold", latencies, time.perf_counter() - start)
+
+    # warm: one client, one task after the other
+    task_util.tasks_client = None
+    timed_enqueue(0)
+    start = time.perf_counter()
+    latencies = [timed_enqueue(i) for i in range(args.tasks)]
+    report("warm", latencies, time.perf_counter() - start)
+
+    # batched: one client, MAX_PARALLEL_ENQUEUES tasks at a time
+    start = time.perf_counter()
+    names = task_util.run_as_background_tasks([task(i) for i in range(args.tasks)])
+    elapsed = time.perf_counter() - start
+    print(f"{'batched':>8}: {len(names)} tasks in {elapsed * 1000:7.1f} ms, "
+          f"{task_util.MAX_PARALLEL_ENQUEUES} at a time")
+
+    print(f"fake server created {fake.created} tasks")
+
+
+if __name__ == "__main__":
+    main_benchmark()
@@ -0,0 +1,91 @@
+"""Compares get_or_insert() + put() with a blind put by key.
+
+Also appends to one shared thread from every writer with
+datastore_util.append_messages(), to check that the version check on
+Thread loses no turns under contention.
+
+Runs against the Datastore emulator with several concurrent writers:
+
+    gcloud beta emulators datastore start --no-store-on-disk
+    $(gcloud beta emulators datastore env-init)
+    python benchmarks/upsert_benchmark.py --writers 8 --writes 50
+"""
+
+import argparse
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "cloud_function"))
+
+from google.cloud import ndb
+
+import datastore_util
+from models import Thread, User
+
+
+def get_or_insert_writer(writer, writes):
+    with datastore_util.get_datastore_client().context():
+        for i in range(writes):
+            user = User.get_or_insert(f"bench-{writer}")
+            user.api_key = f"key-{i}"
+            user.put()
+
+
+def blind_put_writer(writer, writes):
+    with datastore_util.get_datastore_client().context():
+        for i in range(writes):
+            User(id=f"bench-{writer}", api_key=f"key-{i}").put()
+
+
+def versioned_append_writer(writer, writes):
+    failed = 0
+    with datastore_util.get_datastore_client().context():
+        for i in range(writes):
+            try:
+                datastore_util.append_messages("bench-thread", [{"role": "user", "content": f"{writer}-{i}"}])
+            except Exception:
+                failed += 1
+
+    return failed
+
+
+def run(name, writer_func, writers, writes):
+    start = time.perf_counter()
+
+    with ThreadPoolExecutor(max_workers=writers) as executor:
+        futures = [executor.submit(writer_func, writer, writes) for writer in range(writers)]
+        failed = sum(future.result() or 0 for future in futures)
+
+    elapsed = time.perf_counter() - start
+    total = writers * writes
+    print(f"{name:>16}: {total} writes in {elapsed:.2f}s, "
+          f"{elapsed / total * 1000:.1f} ms/write, {total / elapsed:.0f} writes/s, {failed} failed")
+    return total - failed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--writers", type=int, default=8)
+    parser.add_argument("--writes", type=int, default=50)
+    args = parser.parse_args()
+
+    if not os.environ.get("DATASTORE_EMULATOR_HOST"):
+        sys.exit("DATASTORE_EMULATOR_HOST is not set, start the Datastore emulator first")
+
+    run("get_or_insert", get_or_insert_writer, args.writers, args.writes)
+    run("blind put", blind_put_writer, args.writers, args.writes)
+
+    with datastore_util.get_datastore_client().context():
+        ndb.Key(Thread, "bench-thread").delete()
+
+    succeeded = run("versioned append", versioned_append_writer, args.writers, args.writes)
+
+    with datastore_util.get_datastore_client().context():
+        thread = Thread.get_by_id("bench-thread")
+        print(f"thread has {thread.message_count} turns for {succeeded} successful appends")
+
+
+if __name__ == "__main__":
+    main()
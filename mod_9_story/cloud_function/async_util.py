@@ -0,0 +1,88 @@
+import asyncio
+import contextvars
+import functools
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import aiohttp
+import openai
+
+import http_util
+
+# Maximum number of blocking calls (ndb, Chat API client) running at once.
+# This caps the whole instance: calls beyond it from any request wait for a
+# worker. Only short calls belong here, long running work like streaming a
+# reply runs on the event loop instead.
+MAX_BLOCKING_WORKERS = 16
+
+# Blocking calls made from coroutines run here, so they never block the loop.
+blocking_executor = ThreadPoolExecutor(max_workers=MAX_BLOCKING_WORKERS, thread_name_prefix="blocking")
+
+# One event loop per instance, running on a daemon thread. Every request
+# thread hands its coroutine to this loop, so the OpenAI and Chat API calls
+# of all in-flight events share it.
+_loop = None
+_loop_lock = threading.Lock()
+
+# aiohttp session shared by all coroutines, only used on the loop thread.
+_session = None
+
+
+def get_loop():
+    """Returns the shared event loop, starting it on first use."""
+
+    global _loop
+
+    with _loop_lock:
+        if _loop is None:
+            _loop = asyncio.new_event_loop()
+            thread = threading.Thread(target=_loop.run_forever, name="event-loop", daemon=True)
+            thread.start()
+
+    return _loop
+
+
+def run(coro):
+    """Runs coro on the shared event loop and waits for its result.
+
+    Called from synchronous code, such as the functions_framework entry
+    point. The calling thread stays blocked until coro is done, so each
+    event still holds its request thread; the loop only lets the calls
+    within one event, like the image and its title, overlap.
+    """
+
+    future = asyncio.run_coroutine_threadsafe(_run_with_session(coro), get_loop())
+    return future.result()
+
+
+async def _run_with_session(coro):
+    # openai reads its aiohttp session from a context variable
+    openai.aiosession.set(get_session())
+    return await coro
+
+
+def get_session():
+    """Returns the aiohttp session with keep-alive connections to each host."""
+
+    global _session
+
+    if _session is None or _session.closed:
+        connector = aiohttp.TCPConnector(limit_per_host=http_util.POOL_MAXSIZE)
+        timeout = aiohttp.ClientTimeout(total=http_util.REQUEST_TIMEOUT)
+        _session = aiohttp.ClientSession(connector=connector, timeout=timeout)
+
+    return _session
+
+
+async def to_thread(func, *args, **kwargs):
+    """Runs a blocking function on blocking_executor and awaits its result.
+
+    The function sees the caller's context variables, including the
+    request's ndb context.
+    """
+
+    loop = asyncio.get_running_loop()
+    context = contextvars.copy_context()
+    call = functools.partial(context.run, func, *args, **kwargs)
+
+    return await loop.run_in_executor(blocking_executor, call)
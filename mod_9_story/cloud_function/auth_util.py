@@ -1,7 +1,5 @@
 import logging
-from oauth2client import client
-import google.auth
-import requests
+from cert_util import get_cert_cache, verify_token
 from task_util import SERVICE_ACCOUNT_EMAIL, TRIGGER_URL
 
 # Bearer Tokens received by apps will always specify this issuer.
@@ -14,8 +12,17 @@ PUBLIC_CERT_URL_PREFIX = 'https://www.googleapis.com/service_accounts/v1/metadat
 # TODO: Update audience with project number
 AUDIENCE = 'XXXXXXXXXXXX'
 
+# Url to obtain the public certificates used to sign Cloud Tasks OIDC tokens.
+TASK_CERTS_URL = 'https://www.googleapis.com/oauth2/v1/certs'
+
+# OIDC tokens attached by Cloud Tasks will always specify this issuer.
+TASK_ISSUER = 'https://accounts.google.com'
+
 def is_request_valid(request):
-    """Verify the validity of a bearer token received by an app, using OAuth2Client.
+    """Verify the validity of a bearer token received by an app.
+
+    The token is checked against the cached public certificates of
+    CHAT_ISSUER, so this normally makes no outbound request.
 
     Args:
         request: The request object containing the Authorization header with the bearer token.
@@ -36,7 +43,8 @@ def is_request_valid(request):
         token = auth_header.split(' ')[1]
 
         # Verify valid token, signed by CHAT_ISSUER, intended for a third party.
-        token = client.verify_id_token(token, AUDIENCE, cert_uri=PUBLIC_CERT_URL_PREFIX + CHAT_ISSUER)
+        cert_cache = get_cert_cache(PUBLIC_CERT_URL_PREFIX + CHAT_ISSUER)
+        token = verify_token(token, cert_cache, AUDIENCE)
 
         logging.info("verified token: %s" % token)
 
@@ -50,10 +58,11 @@ def is_request_valid(request):
 
 
 def is_backround_request_valid(request):
-    """Validates a background request from Cloud Tasks."""
+    """Validates a background request from Cloud Tasks.
 
-    CERTS_PATH = "https://www.googleapis.com/oauth2/v1/certs"
-    TASK_ISSUER = "https://accounts.google.com"
+    Uses the shared certificate cache, and repeated deliveries of a task
+    with the same token are answered from the verified token memo.
+    """
 
     try:
         # Get the token from the Authorization header
@@ -63,11 +72,9 @@ def is_backround_request_valid(request):
         
         token = auth_header.split(' ')[1]
 
-        response = requests.get(CERTS_PATH)
-        certs = response.json()
-
         # Validate the token.
-        id_token = google.auth.jwt.decode(token, certs=certs, audience=TRIGGER_URL)
+        cert_cache = get_cert_cache(TASK_CERTS_URL)
+        id_token = verify_token(token, cert_cache, TRIGGER_URL)
 
         logging.info(f"background request id_token: {id_token}")
 
@@ -0,0 +1,167 @@
+import base64
+import hashlib
+import json
+import logging
+import re
+import threading
+import time
+
+from google.auth import jwt
+
+import http_util
+from cache_util import LRUCache
+
+# Used when the cert endpoint doesn't send a Cache-Control max-age.
+DEFAULT_MAX_AGE_SECONDS = 300
+
+# Refresh certificates in the background this long before they expire.
+REFRESH_MARGIN_SECONDS = 60
+
+# Tokens with an unknown kid trigger at most one refetch per interval.
+MIN_REFETCH_INTERVAL_SECONDS = 30
+
+# Seconds a token's iat and exp may be off from the instance clock, as
+# oauth2client allowed before.
+CLOCK_SKEW_SECONDS = 300
+
+# Maximum number of verified tokens remembered until they expire.
+VERIFIED_TOKEN_MEMO_SIZE = 1024
+
+# One CertCache per cert url, shared by every caller in the process.
+cert_caches = {}
+cert_caches_lock = threading.Lock()
+
+# Claims of verified tokens, keyed by a hash of (audience, token).
+verified_tokens = LRUCache(maxsize=VERIFIED_TOKEN_MEMO_SIZE)
+
+
+class CertCache:
+    """Caches the public certificates of a token issuer, keyed by kid.
+
+    Certificates are kept for the max-age sent by the cert endpoint and
+    refreshed in the background shortly before they expire, so verifying
+    a token normally needs no outbound request. The endpoint is only
+    fetched on the request path when the cache is empty, expired, or
+    doesn't know the kid of the token.
+    """
+
+    def __init__(self, cert_url):
+        self.cert_url = cert_url
+        self._certs = {}
+        self._expires_at = 0
+        self._fetched_at = 0
+        self._lock = threading.Lock()
+        self._refresh_timer = None
+
+    def get_cert(self, kid):
+        """Returns the certificate for kid, or None if the issuer doesn't have one."""
+
+        now = time.time()
+        is_fresh = now < self._expires_at
+        if kid in self._certs and is_fresh:
+            return self._certs[kid]
+
+        # unknown kid or expired certs, refetch before giving up
+        if not is_fresh or now - self._fetched_at > MIN_REFETCH_INTERVAL_SECONDS:
+            self._refresh(requested_at=now)
+
+        return self._certs.get(kid)
+
+    def _refresh(self, requested_at=None):
+        """Fetches the certificates and schedules the next background refresh.
+
+        Single flight: callers that were waiting on the lock while another
+        thread fetched reuse that result instead of fetching again.
+        """
+
+        with self._lock:
+            if requested_at is not None and self._fetched_at >= requested_at:
+                return
+
+            response = http_util.session.get(self.cert_url, timeout=http_util.REQUEST_TIMEOUT)
+            response.raise_for_status()
+
+            max_age = parse_max_age(response.headers.get("Cache-Control", ""))
+            self._certs = response.json()
+            self._fetched_at = time.time()
+            self._expires_at = self._fetched_at + max_age
+
+            logging.info(f"fetched {len(self._certs)} certs from {self.cert_url}, max-age {max_age}")
+            self._schedule_refresh(max_age - REFRESH_MARGIN_SECONDS)
+
+    def _schedule_refresh(self, delay):
+        """Refreshes the certificates after delay seconds on a daemon thread."""
+
+        if self._refresh_timer:
+            self._refresh_timer.cancel()
+
+        self._refresh_timer = threading.Timer(max(delay, 1), self._background_refresh)
+        self._refresh_timer.daemon = True
+        self._refresh_timer.start()
+
+    def _background_refresh(self):
+        try:
+            self._refresh()
+        except Exception as e:
+            # keep serving the current certs, the request path refetches once they expire
+            logging.warning(f"background refresh of {self.cert_url} failed: {e}")
+            self._schedule_refresh(REFRESH_MARGIN_SECONDS / 2)
+
+
+def get_cert_cache(cert_url):
+    """Returns the process wide CertCache for cert_url."""
+
+    with cert_caches_lock:
+        if cert_url not in cert_caches:
+            cert_caches[cert_url] = CertCache(cert_url)
+
+        return cert_caches[cert_url]
+
+
+def verify_token(token, cert_cache, audience):
+    """Verifies a JWT against the certificates in cert_cache.
+
+    Returns the token claims. Tokens that were already verified are
+    answered from memory until they expire.
+
+    Raises: ValueError if the token is invalid.
+    """
+
+    memo_key = hashlib.sha256(f"{audience}:{token}".encode()).hexdigest()
+    claims = verified_tokens.get(memo_key)
+    if claims:
+        return claims
+
+    kid = get_token_kid(token)
+    cert = cert_cache.get_cert(kid)
+    if not cert:
+        raise ValueError(f"No certificate for key id {kid}")
+
+    claims = jwt.decode(token, certs={kid: cert}, audience=audience,
+                        clock_skew_in_seconds=CLOCK_SKEW_SECONDS)
+
+    ttl = claims.get("exp", 0) - time.time()
+    if ttl > 0:
+        verified_tokens.set(memo_key, claims, ttl=ttl)
+
+    return claims
+
+
+def parse_max_age(cache_control):
+    """Returns the max-age in seconds from a Cache-Control header value."""
+
+    match = re.search(r"max-age=(\d+)", cache_control)
+    if not match:
+        return DEFAULT_MAX_AGE_SECONDS
+
+    return int(match.group(1))
+
+
+def get_token_kid(token):
+    """Returns the kid from the header of a JWT without verifying it."""
+
+    header_segment = token.split(".")[0]
+    header_segment += "=" * (-len(header_segment) % 4)
+    header = json.loads(base64.urlsafe_b64decode(header_segment))
+
+    return header.get("kid")
@@ -1,52 +1,361 @@
+import contextlib
+import functools
 import logging
+import threading
 
+from google.api_core import exceptions as core_exceptions
 from google.cloud import ndb
 from models import *
+from cache_util import LRUCache
+import deadline_util
 
-datastore_client = ndb.Client()
+# Created on first use by get_datastore_client(), so events that don't
+# touch Datastore never pay for the client and its credential lookup.
+datastore_client = None
+datastore_client_lock = threading.Lock()
 
-def store_messages(thread_id, messages=[], thread_type=""):
-    """Stores a list of messages for the thread_id.
+# Seconds an API key (or the lack of one) is cached in the instance.
+# Keys saved on another instance are only seen here after these expire,
+# so users who haven't configured a key yet are cached briefly.
+API_KEY_CACHE_TTL = 600
+NO_API_KEY_CACHE_TTL = 30
 
-    Uses get_or_insert() to ensure only one Thread entity exists per thread_id.
+# Cached API keys by user_id. NO_API_KEY marks users without a key.
+api_key_cache = LRUCache(maxsize=1000, ttl=API_KEY_CACHE_TTL)
+NO_API_KEY = ""
+
+def get_datastore_client():
+    """Returns the ndb client of the instance, creating it on first use."""
+
+    global datastore_client
+
+    with datastore_client_lock:
+        if datastore_client is None:
+            datastore_client = ndb.Client()
+
+    return datastore_client
+
+def ndb_context():
+    """Returns a context manager for the ndb context to use.
+
+    Inside with_request_context() that's the request's context, so every
+    Datastore call of the request shares its cache and batching. Otherwise
+    a new context is opened for the call.
+    """
+
+    if ndb.get_context(raise_context_error=False):
+        return contextlib.nullcontext()
+
+    return get_datastore_client().context()
+
+def with_request_context(func):
+    """Decorator that runs func, e.g. a request handler, in one ndb context.
+
+    Nested uses share the outer context.
+    """
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        with ndb_context():
+            return func(*args, **kwargs)
+
+    return wrapper
+
+# Maximum number of recent turns loaded with a thread.
+MAX_LOADED_TURNS = 40
+
+# Attempts to write a thread that other requests keep writing concurrently.
+MAX_WRITE_ATTEMPTS = 3
+
+def start_conversation(thread_id, system_messages=[], messages=[], thread_type="", thread_obj=None):
+    """Starts a new conversation in the thread with the given messages.
+
+    Earlier turns stay stored but are no longer loaded with the thread.
+    The thread and the new Message entities are written in one batch.
+    Pass the thread_obj loaded for this request to skip reading it.
     """
 
     if not thread_id:
         return
 
-    with datastore_client.context():
-        thread = Thread.get_or_insert(thread_id)
-        thread.message_history = { "messages" : messages }
+    def start(thread):
         thread.thread_type = thread_type
+        thread.system_messages = system_messages
+        thread.summary = None
+        thread.start_index = thread.message_count
+        thread.set_turns([])
+        return _append(thread, messages)
+
+    with ndb_context():
+        thread = thread_obj or _get_thread(thread_id)
+        _put_versioned(thread_id, thread, start)
+
+def append_messages(thread_id, messages, thread_obj=None):
+    """Appends messages to the current conversation of the thread.
+
+    Only the new Message entities and the thread's message_count are
+    written. Pass the thread_obj loaded for this request to skip reading it.
+    """
+
+    if not thread_id:
+        return
+
+    with ndb_context():
+        thread = thread_obj or _get_thread(thread_id)
+        _put_versioned(thread_id, thread, lambda thread: _append(thread, messages))
+
+def _put_versioned(thread_id, thread, update):
+    """Puts the entities returned by update(thread), unless the thread changed.
+
+    Turns are numbered by Thread.message_count, so two requests appending
+    to the same thread from the same version would overwrite each other's
+    turns. The write commits only if the stored version still matches the
+    one thread was read at; otherwise the thread is read again and update
+    is applied to the current version. A thread with a legacy
+    message_history is migrated in the same commit.
+
+    Returns the thread as written.
+    """
+
+    for attempt in range(MAX_WRITE_ATTEMPTS):
+        if not thread:
+            thread = Thread(id=thread_id, message_count=0)
+
+        expected_version = thread.version or 0
+        migration = thread.migrate_message_history()[1:] if thread.needs_migration() else []
+        entities = update(thread) + migration
+        thread.version = expected_version + 1
+
+        if _commit_if_version(thread.key, expected_version, entities):
+            return thread
+
+        logging.info(f"thread {thread_id} was written concurrently, retrying")
+        thread = Thread.get_by_id(thread_id, use_cache=False)
+        # a legacy thread is migrated by the next attempt
+        if thread and not thread.needs_migration():
+            _load_turns(thread, MAX_LOADED_TURNS)
+
+    raise Exception(f"Too many concurrent writes to thread {thread_id}")
+
+@ndb.transactional()
+def _commit_if_version(thread_key, expected_version, entities):
+    current = thread_key.get(use_cache=False)
+    current_version = (current.version or 0) if current else 0
+    if current_version != expected_version:
+        return False
+
+    ndb.put_multi(entities)
+    return True
+
+def _append(thread, messages):
+    """Returns the thread and new Message entities to put for messages."""
+
+    entities = [thread]
+    for turn in messages:
+        entities.append(Message.for_turn(thread.key, thread.message_count, turn))
+        thread.message_count += 1
+
+    thread.set_turns(getattr(thread, "_turns", []) + list(messages))
+    return entities
+
+def store_summary(thread_id, summary, start_index, new_start_index):
+    """Stores summary for the turns of the thread before new_start_index.
+
+    Does nothing if the thread no longer starts at start_index (e.g. the
+    user started a new conversation meanwhile). Runs in a transaction.
+
+    Returns True if the summary was stored.
+    """
+
+    @ndb.transactional()
+    def update_summary():
+        thread = Thread.get_by_id(thread_id)
+        if not thread or thread.start_index != start_index:
+            return False
+
+        thread.summary = summary
+        thread.start_index = new_start_index
+        thread.version = (thread.version or 0) + 1
         thread.put()
+        return True
+
+    with ndb_context():
+        return update_summary()
+
+def get_thread(thread_id, max_turns=MAX_LOADED_TURNS, use_cache=None):
+    """Returns thread_obj for thread_id, with up to max_turns recent turns loaded.
 
-def get_thread(thread_id):
-    """Returns thread_obj for thread_id."""
+    Threads stored before Message entities existed are migrated on first read.
+    Pass use_cache=False to read what's stored, not the context cache.
+    """
 
     if not thread_id:
         return None
 
-    with datastore_client.context():
-        thread_obj = Thread.get_by_id(thread_id)
+    with ndb_context():
+        return _get_thread(thread_id, max_turns, use_cache)
+
+@contextlib.contextmanager
+def _within_deadline():
+    """Raises DeadlineExceeded for Datastore timeouts during a request with a deadline."""
+
+    try:
+        yield
+    except core_exceptions.DeadlineExceeded as e:
+        if deadline_util.current() is not None:
+            raise deadline_util.DeadlineExceeded("Datastore didn't respond before the deadline") from e
+        raise
+
+def get_api_key_and_thread(user_id, thread_id, max_turns=MAX_LOADED_TURNS):
+    """Returns (api_key, thread_obj) for a message, reading both at once.
+
+    The User and Thread entities are read in one batch, while a query
+    reads the thread's recent turns, so both take one round trip. The
+    User entity is only read if the API key isn't cached. thread_obj is
+    None if thread_id is None or the thread doesn't exist yet.
+    """
+
+    api_key = api_key_cache.get(user_id)
+
+    keys = []
+    if api_key is None:
+        keys.append(ndb.Key(User, user_id))
+    if thread_id:
+        keys.append(ndb.Key(Thread, thread_id))
+
+    with ndb_context():
+        # bounded by the request's deadline, if it has one, see deadline_util
+        with _within_deadline():
+            timeout = deadline_util.timeout()
+            entity_futures = ndb.get_multi_async(keys, timeout=timeout)
+            if thread_id:
+                messages_future = _query_recent_messages(ndb.Key(Thread, thread_id), max_turns, timeout)
+
+            entities = [future.result() for future in entity_futures]
+            messages = messages_future.result() if thread_id else []
+
+        if api_key is None:
+            user = entities.pop(0)
+            api_key = user.api_key if user else None
+            _cache_api_key(user_id, api_key)
+
+        thread_obj = entities.pop(0) if thread_id else None
+        if thread_obj:
+            if thread_obj.needs_migration():
+                thread_obj = _load_turns(thread_obj, max_turns)
+            else:
+                _set_recent_turns(thread_obj, messages)
+
+    return api_key or None, thread_obj
+
+def _get_thread(thread_id, max_turns=MAX_LOADED_TURNS, use_cache=None):
+    thread_obj = Thread.get_by_id(thread_id, use_cache=use_cache)
+    if thread_obj:
+        thread_obj = _load_turns(thread_obj, max_turns)
+
+    return thread_obj
+
+def _load_turns(thread_obj, max_turns):
+    """Loads the most recent turns of thread_obj, migrating it if needed.
+
+    Returns thread_obj, or the thread as migrated if it was written
+    meanwhile.
+    """
+
+    # committed with a version check like every Thread write, and like for
+    # other threads only the last max_turns turns are kept
+    if thread_obj.needs_migration():
+        thread_obj = _put_versioned(thread_obj.key.id(), thread_obj, lambda thread: [thread])
+        thread_obj.set_turns(getattr(thread_obj, "_turns", [])[-max_turns:])
         return thread_obj
 
+    # Message ids are their index, so the tail is one batch get by key
+    first_index = max(thread_obj.start_index, thread_obj.message_count - max_turns)
+    keys = [Message.key_for(thread_obj.key, index)
+            for index in range(first_index, thread_obj.message_count)]
+    with _within_deadline():
+        messages = ndb.get_multi(keys, timeout=deadline_util.timeout())
+
+    turns = [message.as_turn() for message in messages if message]
+    thread_obj.set_turns(turns)
+    return thread_obj
+
+def _query_recent_messages(thread_key, max_turns, timeout=None):
+    """Starts reading the last max_turns Messages of the thread, newest first.
+
+    Unlike _load_turns() this doesn't need the thread's message_count, so
+    it runs alongside the read of the thread. Returns a future. The query
+    needs the Message index in index.yaml.
+    """
+
+    query = Message.query(ancestor=thread_key).order(-Message.key)
+    return query.fetch_async(limit=max_turns, timeout=timeout)
+
+def _set_recent_turns(thread_obj, messages):
+    """Sets the turns of thread_obj from messages read by _query_recent_messages().
+
+    Turns of earlier conversations, and turns written after the thread
+    was read, are left out.
+    """
+
+    turns = [message.as_turn() for message in reversed(messages)
+             if thread_obj.start_index <= message.index() < thread_obj.message_count]
+    thread_obj.set_turns(turns)
+
+def migrate_threads(batch_size=100):
+    """Migrates every Thread that still stores a legacy message_history.
+
+    Threads are also migrated lazily by get_thread(), this does it upfront.
+    Returns the number of threads migrated.
+    """
+
+    migrated = 0
+
+    with ndb_context():
+        cursor = None
+        more = True
+        while more:
+            threads, cursor, more = Thread.query().fetch_page(batch_size, start_cursor=cursor)
+            for thread in threads:
+                if thread.needs_migration():
+                    _put_versioned(thread.key.id(), thread, lambda thread: [thread])
+                    migrated += 1
+
+    logging.info(f"migrated {migrated} threads")
+    return migrated
+
 def store_api_key(user_id, api_key):
     """Stores an API key for a user.
 
-    Uses get_or_insert() to ensure only one User entity exists per user_id.
+    The User entity only holds the API key, so it's written by key in a
+    single put instead of a get_or_insert() transaction followed by a put.
     """
 
-    with datastore_client.context():
-        user = User.get_or_insert(user_id)
-        user.api_key = api_key
-        user.put()
+    with ndb_context():
+        User(id=user_id, api_key=api_key).put()
+
+    _cache_api_key(user_id, api_key)
 
 def get_api_key(user_id):
-    """Returns API key for user_id."""
+    """Returns API key for user_id.
 
-    with datastore_client.context():
+    Served from api_key_cache when possible, so steady state messages
+    don't read the User entity.
+    """
+
+    api_key = api_key_cache.get(user_id)
+    if api_key is not None:
+        return api_key or None
+
+    with ndb_context():
         user = User.get_by_id(user_id)
-        if user:
-            return user.api_key
-        else:
-            return None
\ No newline at end of file
+        api_key = user.api_key if user else None
+
+    _cache_api_key(user_id, api_key)
+    return api_key
+
+def _cache_api_key(user_id, api_key):
+    if api_key:
+        api_key_cache.set(user_id, api_key)
+    else:
+        api_key_cache.set(user_id, NO_API_KEY, ttl=NO_API_KEY_CACHE_TTL)
\ No newline at end of file
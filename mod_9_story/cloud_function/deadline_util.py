@@ -0,0 +1,81 @@
+import contextlib
+import contextvars
+import time
+
+
+class DeadlineExceeded(Exception):
+    """Raised when a call can't be made, or didn't finish, within the deadline."""
+
+
+class Deadline:
+    """The time a request has to respond by.
+
+    reserve seconds before the end are kept back from the work, for
+    replying after it ran out of time, e.g. with a placeholder message.
+    """
+
+    def __init__(self, seconds, reserve=0):
+        self.started_at = time.monotonic()
+        self.expires_at = self.started_at + seconds
+        self.reserve = reserve
+
+    def remaining(self, include_reserve=False):
+        """Seconds left for work, or until the end with include_reserve."""
+
+        left = self.expires_at - time.monotonic()
+        if not include_reserve:
+            left -= self.reserve
+
+        return max(0.0, left)
+
+    def elapsed(self):
+        return time.monotonic() - self.started_at
+
+
+# The deadline of the current request. Like the ndb context, it's seen by
+# the coroutines and blocking calls of the request, see async_util.
+_current = contextvars.ContextVar("deadline", default=None)
+
+
+def current():
+    """Returns the Deadline of the current request, or None."""
+
+    return _current.get()
+
+
+@contextlib.contextmanager
+def deadline(seconds, reserve=0):
+    """Runs the block with a Deadline seconds from now."""
+
+    token = _current.set(Deadline(seconds, reserve))
+    try:
+        yield _current.get()
+    finally:
+        _current.reset(token)
+
+
+def timeout(default=None, include_reserve=False):
+    """Returns the timeout for a call made now.
+
+    That's the time left before the current deadline, at most default.
+    Without a deadline it's default.
+
+    Raises: DeadlineExceeded if no time is left.
+    """
+
+    current_deadline = _current.get()
+    if current_deadline is None:
+        return default
+
+    left = current_deadline.remaining(include_reserve)
+    if left <= 0:
+        raise DeadlineExceeded("No time left before the deadline")
+
+    return left if default is None else min(default, left)
+
+
+def expired():
+    """Returns True if the current deadline left no time for work."""
+
+    current_deadline = _current.get()
+    return current_deadline is not None and current_deadline.remaining() <= 0
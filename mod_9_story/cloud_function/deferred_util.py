@@ -0,0 +1,99 @@
+import contextvars
+import functools
+import logging
+import time
+
+import flask
+
+# Attempts of a deferred call before it's given up.
+MAX_ATTEMPTS = 3
+
+# Seconds to wait before the first retry, doubled for every retry after it.
+RETRY_DELAY_SECONDS = 0.5
+
+# Calls deferred by the current request, set up by with_deferred_calls().
+_pending_calls = contextvars.ContextVar("pending_calls", default=None)
+
+# Attempt of the deferred call that's running, 0 for the first.
+_attempt = contextvars.ContextVar("attempt", default=0)
+
+
+def defer(func, *args, **kwargs):
+    """Runs func(*args, **kwargs) after the response has been sent.
+
+    Outside of with_deferred_calls() func runs right away. Failed calls are
+    retried MAX_ATTEMPTS times with backoff, then logged as errors. Calls
+    deferred by a deferred call run after it, so defer them once nothing
+    else in it can fail, or a retry defers them again.
+
+    Durability: deferred calls only live in the memory of the instance.
+    They are lost if the instance is shut down before they finish, and
+    only get CPU after the response if CPU is always allocated (Cloud
+    Functions 2nd gen / Cloud Run). Only defer writes that can be lost.
+
+    A retry runs func again from the start, and the failed attempt may
+    have partly succeeded, e.g. committed a write before a later step
+    raised. Unless func is safe to repeat, retries write twice: defer
+    steps that can fail separately, and have func check is_retry() and
+    skip work that's already done.
+    """
+
+    pending = _pending_calls.get()
+    call = functools.partial(func, *args, **kwargs)
+
+    if pending is None:
+        call()
+    else:
+        pending.append(call)
+
+
+def is_retry():
+    """Returns True if the deferred call that's running was attempted before."""
+
+    return _attempt.get() > 0
+
+
+def with_deferred_calls(func):
+    """Decorator for a request handler that runs deferred calls after the response."""
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        pending = []
+        token = _pending_calls.set(pending)
+        try:
+            response = flask.make_response(func(*args, **kwargs))
+        finally:
+            _pending_calls.reset(token)
+
+        if pending:
+            response.call_on_close(lambda: run_calls(pending))
+
+        return response
+
+    return wrapper
+
+
+def run_calls(calls):
+    """Runs calls in order, retrying each one that fails.
+
+    Calls deferred meanwhile are appended to calls, and run after them.
+    """
+
+    pending_token = _pending_calls.set(calls)
+    try:
+        for call in calls:
+            for attempt in range(MAX_ATTEMPTS):
+                token = _attempt.set(attempt)
+                try:
+                    call()
+                    break
+                except Exception as e:
+                    if attempt == MAX_ATTEMPTS - 1:
+                        logging.error(f"deferred call {call.func.__name__} failed, giving up: {e}")
+                    else:
+                        logging.warning(f"deferred call {call.func.__name__} failed, retrying: {e}")
+                        time.sleep(RETRY_DELAY_SECONDS * 2 ** attempt)
+                finally:
+                    _attempt.reset(token)
+    finally:
+        _pending_calls.reset(pending_token)
@@ -1,41 +1,224 @@
+import asyncio
+import contextlib
 import openai
+from concurrent.futures import ThreadPoolExecutor
 
-def get_gpt_response(messages):
+import deadline_util
+# installs the pooled session used by openai
+import http_util
+import prompt_cache_util
+import retry_util
+
+# Runs OpenAI calls that don't depend on each other concurrently.
+executor = ThreadPoolExecutor(max_workers=8, thread_name_prefix="gpt")
+
+GPT_MODEL = "gpt-3.5-turbo"
+GPT_TEMPERATURE = 1.1
+IMAGE_SIZE = "1024x1024"
+
+# Seconds after which a chat completion that hasn't returned yet is
+# requested again, see retry_util.call_async(). None, the default, never
+# hedges: long replies are slow because they are long, and a second
+# request for them is billed without finishing sooner. If enabled, set
+# it above the p99 latency of the replies. Images are never hedged.
+HEDGE_AFTER_SECONDS = None
+
+# Every function takes an optional api_key. When it isn't provided the
+# global openai.api_key is used, which is only safe when one request at
+# a time runs in the process.
+#
+# Chat functions also take use_cache, to mark prompts whose response can
+# be reused for the same prompt, see prompt_cache_util.
+#
+# Calls made during a request with a deadline, see deadline_util, time out
+# when it's reached and raise deadline_util.DeadlineExceeded.
+#
+# Transient errors are retried with backoff, and calls fail fast while
+# calls with the same API key keep failing, see retry_util.
+
+
+@contextlib.contextmanager
+def _within_deadline():
+    """Raises DeadlineExceeded for timeouts caused by the request's deadline."""
+
+    try:
+        yield
+    except (openai.error.Timeout, asyncio.TimeoutError) as e:
+        if deadline_util.expired():
+            raise deadline_util.DeadlineExceeded("OpenAI didn't respond before the deadline") from e
+        raise
+
+
+def get_gpt_response(messages, api_key=None, use_cache=False):
     """Processes messages using ChatGPT.
-    
+
     Returns: a response from ChatGPT.
 
-    Raises: openai.error.OpenAIError
+    Raises: openai.error.OpenAIError, deadline_util.DeadlineExceeded
 
-    API Details here: https://platform.openai.com/docs/api-reference/chat/create 
+    API Details here: https://platform.openai.com/docs/api-reference/chat/create
     """
 
-    completion = openai.ChatCompletion.create(
-        model="gpt-3.5-turbo",
-        temperature=1.1,
-        messages=messages
-    )
+    use_cache = use_cache and prompt_cache_util.ENABLED
+    if use_cache:
+        key = prompt_cache_util.cache_key(GPT_MODEL, GPT_TEMPERATURE, messages)
+        cached_response = prompt_cache_util.get_response(key)
+        if cached_response is not None:
+            return cached_response
 
+    def request():
+        with _within_deadline():
+            return openai.ChatCompletion.create(
+                model=GPT_MODEL,
+                temperature=GPT_TEMPERATURE,
+                messages=messages,
+                api_key=api_key,
+                request_timeout=deadline_util.timeout()
+            )
+
+    completion = retry_util.call(request, api_key)
     gpt_response = completion['choices'][0]['message']['content']
 
+    if use_cache:
+        prompt_cache_util.store_response(key, gpt_response)
+
     return gpt_response
 
 
-def create_image_with_prompt(image_prompt):
+async def get_gpt_response_async(messages, api_key=None, use_cache=False):
+    """Async version of get_gpt_response().
+
+    Raises: openai.error.OpenAIError, deadline_util.DeadlineExceeded
+    """
+
+    use_cache = use_cache and prompt_cache_util.ENABLED
+    if use_cache:
+        key = prompt_cache_util.cache_key(GPT_MODEL, GPT_TEMPERATURE, messages)
+        cached_response = await prompt_cache_util.get_response_async(key)
+        if cached_response is not None:
+            return cached_response
+
+    async def request():
+        with _within_deadline():
+            return await openai.ChatCompletion.acreate(
+                model=GPT_MODEL,
+                temperature=GPT_TEMPERATURE,
+                messages=messages,
+                api_key=api_key,
+                request_timeout=deadline_util.timeout()
+            )
+
+    completion = await retry_util.call_async(request, api_key, hedge_after=HEDGE_AFTER_SECONDS)
+    gpt_response = completion['choices'][0]['message']['content']
+
+    if use_cache:
+        await prompt_cache_util.store_response_async(key, gpt_response)
+
+    return gpt_response
+
+
+def stream_gpt_response(messages, api_key=None):
+    """Processes messages using ChatGPT, streaming the response.
+
+    Returns: a generator of the pieces of text of the response, as they arrive.
+
+    Raises: openai.error.OpenAIError, deadline_util.DeadlineExceeded
+
+    API Details here: https://platform.openai.com/docs/api-reference/chat/create
+    """
+
+    def request():
+        with _within_deadline():
+            return openai.ChatCompletion.create(
+                model=GPT_MODEL,
+                temperature=GPT_TEMPERATURE,
+                messages=messages,
+                stream=True,
+                api_key=api_key,
+                request_timeout=deadline_util.timeout()
+            )
+
+    # only the request is retried, not a response that fails part way
+    completion = retry_util.call(request, api_key)
+
+    with _within_deadline():
+        for chunk in completion:
+            content = chunk['choices'][0]['delta'].get('content')
+            if content:
+                yield content
+
+
+async def stream_gpt_response_async(messages, api_key=None):
+    """Async version of stream_gpt_response(), returns an async generator.
+
+    Raises: openai.error.OpenAIError, deadline_util.DeadlineExceeded
+    """
+
+    async def request():
+        with _within_deadline():
+            return await openai.ChatCompletion.acreate(
+                model=GPT_MODEL,
+                temperature=GPT_TEMPERATURE,
+                messages=messages,
+                stream=True,
+                api_key=api_key,
+                request_timeout=deadline_util.timeout()
+            )
+
+    # only the request is retried, not a response that fails part way
+    completion = await retry_util.call_async(request, api_key)
+
+    with _within_deadline():
+        async for chunk in completion:
+            content = chunk['choices'][0]['delta'].get('content')
+            if content:
+                yield content
+
+
+def create_image_with_prompt(image_prompt, api_key=None):
     """Generates an image using DALL-E.
-    
+
     Returns: url of new image.
 
-    Raises: openai.error.OpenAIError
+    Raises: openai.error.OpenAIError, deadline_util.DeadlineExceeded
 
     API Details here: https://platform.openai.com/docs/api-reference/images
     """
 
-    response = openai.Image.create(
-        prompt=image_prompt,
-        n=1,
-        size="1024x1024"
-    )
+    def request():
+        # Image.create doesn't take a request_timeout, this only fails fast
+        # when no time is left
+        deadline_util.timeout()
+        return openai.Image.create(
+            prompt=image_prompt,
+            n=1,
+            size=IMAGE_SIZE,
+            api_key=api_key
+        )
+
+    response = retry_util.call(request, api_key)
+
+    image_url = response['data'][0]['url']
+    return image_url
+
+
+async def create_image_with_prompt_async(image_prompt, api_key=None):
+    """Async version of create_image_with_prompt().
+
+    Raises: openai.error.OpenAIError, deadline_util.DeadlineExceeded
+    """
+
+    async def request():
+        # Image.acreate doesn't take a request_timeout, so it's awaited with one
+        with _within_deadline():
+            return await asyncio.wait_for(openai.Image.acreate(
+                prompt=image_prompt,
+                n=1,
+                size=IMAGE_SIZE,
+                api_key=api_key
+            ), deadline_util.timeout())
+
+    response = await retry_util.call_async(request, api_key)
 
     image_url = response['data'][0]['url']
-    return image_url
\ No newline at end of file
+    return image_url
@@ -0,0 +1,195 @@
+import logging
+import threading
+import time
+
+import tiktoken
+
+import datastore_util
+import gpt_util
+import metrics_util
+
+# Maximum number of prompt tokens of history sent to ChatGPT each turn.
+# gpt-3.5-turbo has a 4,096 token context, this leaves room for the reply.
+MAX_HISTORY_TOKENS = 3000
+
+# Tokens ChatGPT adds around every message for its role and separators.
+TOKENS_PER_MESSAGE = 4
+
+# Once a thread has more turns than this, older turns are summarized.
+SUMMARIZE_AFTER_MESSAGES = 20
+
+# Number of most recent turns that are never summarized.
+KEEP_RECENT_MESSAGES = 10
+
+# Characters per token, to estimate token counts while the encoding
+# isn't loaded.
+CHARS_PER_TOKEN = 4
+
+# Seconds before loading the encoding again after it failed.
+ENCODING_RETRY_SECONDS = 300
+
+# The encoding is loaded on first use, it's only needed for messages.
+# tiktoken downloads its BPE file from openaipublic.blob.core.windows.net
+# the first time in each instance, unless TIKTOKEN_CACHE_DIR points to a
+# directory it was cached in, so it's loaded on a daemon thread and token
+# counts are estimated until it's ready. Estimates are counted in
+# metrics_util as "history.token_estimates".
+_encoding = None
+_encoding_loading = False
+_encoding_failed_at = None
+_encoding_lock = threading.Lock()
+
+
+def get_encoding():
+    """Returns the tiktoken encoding for gpt_util.GPT_MODEL, or None while it's loading."""
+
+    global _encoding_loading
+
+    with _encoding_lock:
+        if _encoding is not None or _encoding_loading:
+            return _encoding
+
+        if _encoding_failed_at is not None and time.monotonic() - _encoding_failed_at < ENCODING_RETRY_SECONDS:
+            return None
+
+        _encoding_loading = True
+
+    threading.Thread(target=_load_encoding, name="tiktoken", daemon=True).start()
+    return None
+
+
+def _load_encoding():
+    global _encoding, _encoding_loading, _encoding_failed_at
+
+    try:
+        encoding = tiktoken.encoding_for_model(gpt_util.GPT_MODEL)
+    except Exception as e:
+        logging.warning("tiktoken encoding not loaded, estimating token counts: %s" % e)
+        encoding = None
+
+    with _encoding_lock:
+        _encoding = encoding
+        _encoding_failed_at = None if encoding else time.monotonic()
+        _encoding_loading = False
+
+
+def count_tokens(message):
+    """Returns the number of prompt tokens a message uses, estimated if the encoding isn't loaded."""
+
+    encoding = get_encoding()
+    if encoding is None:
+        metrics_util.increment("history.token_estimates")
+        return TOKENS_PER_MESSAGE + len(message["content"]) // CHARS_PER_TOKEN + 1
+
+    return TOKENS_PER_MESSAGE + len(encoding.encode(message["content"]))
+
+
+def split_system_messages(messages):
+    """Returns (system_messages, turns), splitting off the leading system messages."""
+
+    system_count = 0
+    while system_count < len(messages) and messages[system_count]["role"] == "system":
+        system_count += 1
+
+    return messages[:system_count], messages[system_count:]
+
+
+def trim_messages(messages, max_tokens=MAX_HISTORY_TOKENS):
+    """Returns the messages that fit in max_tokens.
+
+    Leading system messages and the most recent message are always kept.
+    The oldest of the other messages are dropped until the rest fit, so
+    the conversation keeps its guidance and its most recent turns.
+
+    Trimmed messages and tokens are counted in metrics_util under
+    "history.messages_trimmed" and "history.tokens_trimmed".
+    """
+
+    system_messages, turns = split_system_messages(messages)
+
+    used_tokens = sum(count_tokens(message) for message in system_messages)
+    kept = []
+
+    # walk back from the newest message, keeping turns while they fit
+    for index, message in enumerate(reversed(turns)):
+        tokens = count_tokens(message)
+        if index > 0 and used_tokens + tokens > max_tokens:
+            break
+        used_tokens += tokens
+        kept.append(message)
+
+    kept.reverse()
+
+    trimmed = turns[:len(turns) - len(kept)]
+    if trimmed:
+        tokens_trimmed = sum(count_tokens(message) for message in trimmed)
+        metrics_util.increment("history.messages_trimmed", len(trimmed))
+        metrics_util.increment("history.tokens_trimmed", tokens_trimmed)
+        logging.info(f"trimmed {len(trimmed)} messages ({tokens_trimmed} tokens) from history")
+
+    return system_messages + kept
+
+
+def summary_message(summary):
+    """Returns the system message that gives ChatGPT the summary of older turns."""
+
+    return {"role": "system", "content": "Summary of the earlier conversation: %s" % summary}
+
+
+def build_prompt(messages, summary=None):
+    """Returns the prompt to send to ChatGPT for a conversation turn.
+
+    That's the system messages, the summary of older turns if there is
+    one, then as many recent turns as fit in the token budget.
+    """
+
+    if not summary:
+        return trim_messages(messages)
+
+    summary_msg = summary_message(summary)
+    messages = trim_messages(messages, MAX_HISTORY_TOKENS - count_tokens(summary_msg))
+
+    system_messages, turns = split_system_messages(messages)
+    return system_messages + [summary_msg] + turns
+
+
+def needs_summary(thread_obj):
+    """Returns True if the thread has enough turns to summarize the older ones."""
+
+    return thread_obj.message_count - thread_obj.start_index > SUMMARIZE_AFTER_MESSAGES
+
+
+def summarize_thread(thread_id, api_key=None):
+    """Folds the turns of a thread older than KEEP_RECENT_MESSAGES into its summary.
+
+    Incremental: only the turns that aged out since the last run are sent
+    to ChatGPT, together with the existing summary. Meant to run as a
+    background task, off the path of the user's message.
+    """
+
+    # a task queued for an earlier turn may find the thread already summarized
+    thread_obj = datastore_util.get_thread(thread_id)
+    if not thread_obj or not needs_summary(thread_obj):
+        return
+
+    system_messages, turns = split_system_messages(thread_obj.get_messages())
+    aged_out = turns[:-KEEP_RECENT_MESSAGES]
+    if not aged_out:
+        return
+
+    # turns not loaded with the thread are too old to be worth summarizing
+    start_index = thread_obj.start_index
+    new_start_index = thread_obj.message_count - KEEP_RECENT_MESSAGES
+
+    transcript = "\n".join("%s: %s" % (message["role"], message["content"]) for message in aged_out)
+    prompt = "Write a concise summary of the following conversation between a "\
+        "user and an assistant, keeping any facts, names and decisions that "\
+        "later messages may refer to."
+    if thread_obj.summary:
+        prompt += " Extend this summary of the conversation before it: %s" % thread_obj.summary
+    prompt += "\r\n\r\n%s" % transcript
+
+    summary = gpt_util.get_gpt_response([{"role": "user", "content": prompt}], api_key)
+
+    stored = datastore_util.store_summary(thread_id, summary, start_index, new_start_index)
+    logging.info(f"summarized {len(aged_out)} messages of {thread_id}, stored: {stored}")
@@ -0,0 +1,53 @@
+import threading
+
+import httplib2
+import openai
+import requests
+from google_auth_httplib2 import AuthorizedHttp
+from requests.adapters import HTTPAdapter
+
+# Number of hosts to keep a connection pool for (certs, OpenAI, Chat API, ...).
+POOL_CONNECTIONS = 10
+
+# Maximum number of kept-alive connections per host.
+POOL_MAXSIZE = 10
+
+# Seconds to wait for an outbound request before giving up.
+REQUEST_TIMEOUT = 60
+
+
+def _make_session():
+    """Creates a requests Session with keep-alive connection pools per host."""
+
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=POOL_CONNECTIONS, pool_maxsize=POOL_MAXSIZE)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+
+    return session
+
+
+# Shared by every requests based caller for the lifetime of the instance,
+# so warm invocations reuse open TCP connections and TLS sessions.
+session = _make_session()
+
+# The OpenAI library keeps a session per thread and closes it every few
+# minutes, so it gets its own pooled sessions from this factory. Giving it
+# the shared session would close the pools of every other caller too.
+openai.requestssession = _make_session
+
+# httplib2.Http objects aren't thread safe, so each worker thread keeps its own.
+_thread_local = threading.local()
+
+
+def get_http(credentials):
+    """Returns an authorized httplib2 transport for googleapiclient.
+
+    The underlying httplib2.Http is kept per thread across requests,
+    so its connections stay open between calls to the Chat API.
+    """
+
+    if not hasattr(_thread_local, "http"):
+        _thread_local.http = httplib2.Http(timeout=REQUEST_TIMEOUT)
+
+    return AuthorizedHttp(credentials, http=_thread_local.http)
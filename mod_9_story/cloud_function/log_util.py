@@ -0,0 +1,47 @@
+import json
+import logging
+import sys
+
+# Send logs with the Cloud Logging client library instead. On Cloud
+# Functions the client also ends up writing JSON lines to stdout, but it's
+# slow to import and looks up the environment on the metadata server first.
+USE_LOGGING_CLIENT = False
+
+
+class StructuredFormatter(logging.Formatter):
+    """Formats records as JSON lines, which Cloud Logging parses from stdout.
+
+    The json_fields of a record, passed with extra={"json_fields": {...}},
+    are added to its line, like the Cloud Logging client does.
+    """
+
+    def format(self, record):
+        entry = {
+            "severity": record.levelname,
+            "message": super().format(record),
+            "logging.googleapis.com/sourceLocation": {
+                "file": record.pathname,
+                "line": record.lineno,
+                "function": record.funcName,
+            },
+        }
+        entry.update(getattr(record, "json_fields", {}))
+
+        return json.dumps(entry)
+
+
+def setup_logging(log_level=logging.INFO):
+    """Sends log records of log_level and above to Cloud Logging."""
+
+    if USE_LOGGING_CLIENT:
+        import google.cloud.logging
+        google.cloud.logging.Client().setup_logging(log_level=log_level)
+        return
+
+    # the stream the Cloud Logging client uses on Cloud Functions
+    handler = logging.StreamHandler(sys.__stdout__)
+    handler.setFormatter(StructuredFormatter())
+
+    root_logger = logging.getLogger()
+    root_logger.addHandler(handler)
+    root_logger.setLevel(log_level)
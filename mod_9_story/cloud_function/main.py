@@ -1,76 +1,175 @@
 import flask
 import functions_framework
+import asyncio
+import functools
 import logging
-import google.cloud.logging
 import openai
 import random
 import string
 
 from auth_util import is_request_valid
 
+import async_util
+import deadline_util
+import deferred_util
 import gpt_util
 import datastore_util
+import history_util
+import log_util
+import metrics_util
+import router_util
+import semantic_cache_util
 import dialog_util
 import story_util
 import task_util
 
-logging_client = google.cloud.logging.Client()
-logging_client.setup_logging(log_level=logging.INFO)
+log_util.setup_logging(log_level=logging.INFO)
+
+# Seconds to keep waiting for the image title once the image is ready.
+IMAGE_TITLE_GRACE_SECONDS = 2
+
+# Title used when the image title isn't ready in time.
+FALLBACK_IMAGE_TITLE = "Your image"
+
+# Stream ChatGPT responses in direct messages by progressively editing a
+# message with the Chat API, instead of replying once the response is done.
+# The event is answered once the placeholder message is sent, and the
+# response streams in after that, within STREAM_DEADLINE_SECONDS.
+STREAM_RESPONSES = False
+STREAM_DEADLINE_SECONDS = 120
+
+# Store the history of direct messages after the reply has been sent,
+# instead of before. A turn can be lost if the instance shuts down before
+# the write finishes, see deferred_util.defer(). A failed write is retried
+# after re-reading the thread, and skipped if the turn was stored anyway.
+WRITE_BEHIND = False
+
+# Slash command ids, as configured for the app in the Chat API.
+NEW_COMMAND_ID = 1
+SNARK_COMMAND_ID = 2
+POET_COMMAND_ID = 3
+IMAGE_COMMAND_ID = 4
+API_KEY_COMMAND_ID = 5
+STORY_COMMAND_ID = 6
+
+# Seconds a handler has to respond, Google Chat waits 30 seconds for a
+# synchronous reply. Background handlers only start the work.
+SYNC_TIMEOUT_SECONDS = 30
+BACKGROUND_TIMEOUT_SECONDS = 5
+
+# Seconds from receiving an event until its reply must be sent, just under
+# the 30 seconds Google Chat waits. The last FALLBACK_RESERVE_SECONDS are
+# kept back from the work, to send a placeholder when it isn't done by then.
+RESPONSE_DEADLINE_SECONDS = 28
+FALLBACK_RESERVE_SECONDS = 4
+
+# Commands calling OpenAI start in the background right away, instead of
+# trying to reply in time, when less than this many seconds are left.
+MIN_SYNC_BUDGET_SECONDS = 5
+
+# Reply in rooms when a command runs out of time, since finishing it in the
+# background needs a direct message to send the placeholder to.
+DEADLINE_EXCEEDED_TEXT = "Sorry, that took too long. Please try again."
+
+# Commands finishing in the background are counted in metrics_util as
+# "deadline.fallback.<reason>" and "deadline.fallback.command.<command_id>".
+# The seconds taken until a command replied in time or fell back are
+# counted in the histograms "deadline.elapsed_s.sync" and
+# "deadline.elapsed_s.fallback". Metrics are logged every
+# metrics_util.EXPORT_INTERVAL_SECONDS, see metrics_util.export().
+
+# Handlers of event types, of the invokedFunction of clicked cards and of
+# slash command ids. A message without a slash command uses the command
+# handler registered for None.
+events = router_util.Router("event")
+card_actions = router_util.Router("card")
+commands = router_util.Router("command")
 
 @functions_framework.http
+@deferred_util.with_deferred_calls
 def handle_chat(request):
-    """Handles incoming messages from Google Chat."""
+    """Handles incoming messages from Google Chat.
+
+    Events that read or write Datastore share one ndb context, the others
+    don't create a Datastore client at all. Calls deferred with
+    deferred_util.defer() run after the response is sent, like the
+    periodic export of metrics_util. Events are
+    handled within RESPONSE_DEADLINE_SECONDS, see deadline_util.
+    """
 
     event_data = request.get_json()
     logging.info("received event_data %s" % event_data)
 
+    # once a minute, after the response, log the metrics of the instance
+    deferred_util.defer(metrics_util.maybe_export)
+
     # routes background tasks for processing
     if event_data.get("background_task", False):
         return task_util.process_background_task(request)
 
-    # verify request is from Google before doing anything
-    if not is_request_valid(request):
-        return "Unauthorized request"
+    with deadline_util.deadline(RESPONSE_DEADLINE_SECONDS, FALLBACK_RESERVE_SECONDS):
 
-    event_type = event_data['type']
+        # verify request is from Google before doing anything
+        if not is_request_valid(request):
+            return "Unauthorized request"
 
-    # Bot added
-    if event_type == 'ADDED_TO_SPACE':
-        
-        # Added to a room
-        if event_data['space']['type'] == 'ROOM':
-            return { "text" : f"Thanks for adding me to the room. "\
-                    "Mention me in a conversation whenever you need help." }
+        return events.dispatch(event_data['type'], event_data, default={})
 
-        # Added to a DM
-        elif event_data['space']['type'] == 'DM':
-            user_display_name = event_data['user']['displayName']
-            return { "text" : f"Hi {user_display_name}! I'm here to help "\
-                     "whenever you need it."}
 
-    # Bot removed
-    elif event_type == 'REMOVED_FROM_SPACE':
-        return {}
+# Bot added
+@events.route('ADDED_TO_SPACE', timeout=SYNC_TIMEOUT_SECONDS)
+def handle_added_to_space(event_data):
 
-    # A card was clicked 
-    elif event_type == 'CARD_CLICKED':
-        invoked_function = event_data.get('common', dict()).get('invokedFunction')
-        if invoked_function == 'get_api_key_dialog':
-            return dialog_util.api_key_dialog()
+    # Added to a room
+    if event_data['space']['type'] == 'ROOM':
+        return { "text" : f"Thanks for adding me to the room. "\
+                "Mention me in a conversation whenever you need help." }
 
-        elif invoked_function == 'save_api_key':
-          return dialog_util.handle_save_api_key(event_data)
+    # Added to a DM
+    elif event_data['space']['type'] == 'DM':
+        user_display_name = event_data['user']['displayName']
+        return { "text" : f"Hi {user_display_name}! I'm here to help "\
+                 "whenever you need it."}
+
+
+# Bot removed
+@events.route('REMOVED_FROM_SPACE')
+def handle_removed_from_space(event_data):
+    return {}
+
+
+# A card was clicked 
+@events.route('CARD_CLICKED', timeout=SYNC_TIMEOUT_SECONDS)
+def handle_card_clicked(event_data):
+    invoked_function = event_data.get('common', dict()).get('invokedFunction')
+    return card_actions.dispatch(invoked_function, event_data, default={})
+
+
+@card_actions.route('get_api_key_dialog')
+def open_api_key_dialog(event_data):
+    return dialog_util.api_key_dialog()
 
-        return {}
 
+@card_actions.route('save_api_key')
+def save_api_key(event_data):
+    with datastore_util.ndb_context():
+        return dialog_util.handle_save_api_key(event_data)
 
-    # A normal message event
-    elif event_type == 'MESSAGE':
-        return process_message_event(event_data)
 
+# A normal message event
+@events.route('MESSAGE', timeout=SYNC_TIMEOUT_SECONDS)
+def handle_message(event_data):
+    # blocks this request thread until the event is done, see async_util.run()
+    with datastore_util.ndb_context():
+        return async_util.run(process_message_event(event_data))
 
-def process_message_event(event_data):
-    """Processes message event."""
+
+async def process_message_event(event_data):
+    """Processes message event.
+
+    Runs on the shared event loop, so waiting on OpenAI or the Chat API
+    doesn't hold a thread. Blocking calls go through async_util.to_thread().
+    """
 
     incoming_message = event_data.get('message', {})
     user_text = incoming_message.get('argumentText', "")
@@ -90,89 +189,223 @@ def process_message_event(event_data):
     if space_type == "DIRECT_MESSAGE":
         thread_id = "%s-%s" % (user_id, space_name)
 
+    command = commands.get(command_id)
+
+    # start reading the user's API key and the thread in one batch
+    # while the rest of the event is handled
+    load_task = None
+    if command.needs_api_key:
+        load_task = asyncio.create_task(
+            async_util.to_thread(datastore_util.get_api_key_and_thread, user_id, thread_id))
+
     logging.info("user_text %s" % user_text)
     logging.info("thread_id: %s" % thread_id)
     logging.info("command_id %s" % command_id)
 
-    # /api_key
-    if command_id == 5:
-      return dialog_util.api_key_dialog()
-
     # get api_key
-    api_key = datastore_util.get_api_key(user_id)
-    if not api_key:
-        return dialog_util.api_key_setup_card()
-
-    openai.api_key = api_key
-
-    # /new
-    if command_id == 1:
-        guidance = "You are helpful assistant who has a cheerful attitude"
-        return process_chat_message(user_text, thread_id, guidance)
-
-    # /snark
-    elif command_id == 2:
-        guidance = "You are a snarky know-it-all that replies to any content "\
-                    "by telling the actual truth of the matter. You usually "\
-                    "start your reply with 'Actually...'"
-        return process_chat_message(user_text, thread_id, guidance)
-
-    # /poet
-    elif command_id == 3:
-        guidance = "You are an esteemed poet that replies to any request "\
-                    "using a rhyming poem"
-        return process_chat_message(user_text, thread_id, guidance)
-
-    # /image
-    elif command_id == 4:
-        return handle_image_command(user_text)
-  
-    # /story
-    elif command_id == 6:
-        message_id_to_update = story_util.send_generating_story_card(thread_id)
-        task_util.run_as_background_task("handle_story_command", thread_id, user_text, message_id_to_update)
-        return {}
+    api_key, thread_obj = None, None
+    if load_task:
+        try:
+            api_key, thread_obj = await load_task
+        except deadline_util.DeadlineExceeded:
+            return await reply_in_background(command_id, user_text, thread_id, "load_timeout")
+
+        if not api_key:
+            return dialog_util.api_key_setup_card()
+
+    # don't start a reply that can't be sent in time
+    deadline = deadline_util.current()
+    if command.needs_api_key and not command.background \
+            and deadline and deadline.remaining() < MIN_SYNC_BUDGET_SECONDS:
+        return await reply_in_background(command_id, user_text, thread_id, "low_budget")
+
+    try:
+        response = await commands.dispatch_async(command_id, user_text, thread_id, api_key, thread_obj)
+    except deadline_util.DeadlineExceeded:
+        if command.background:
+            raise
+        return await reply_in_background(command_id, user_text, thread_id, "timeout")
+
+    if deadline:
+        metrics_util.histogram("deadline.elapsed_s.sync", deadline.elapsed())
+
+    return response
+
+
+# Command handlers take (user_text, thread_id, api_key, thread_obj).
+# api_key and thread_obj are None unless the command needs_api_key.
+
+@commands.route(None, needs_api_key=True, timeout=SYNC_TIMEOUT_SECONDS)
+async def chat_command(user_text, thread_id, api_key, thread_obj):
+    return await process_chat_message(user_text, thread_id, api_key, thread_obj=thread_obj)
+
+
+# /new
+@commands.route(NEW_COMMAND_ID, needs_api_key=True, timeout=SYNC_TIMEOUT_SECONDS)
+async def new_command(user_text, thread_id, api_key, thread_obj):
+    guidance = "You are helpful assistant who has a cheerful attitude"
+    return await process_chat_message(user_text, thread_id, api_key, guidance, thread_obj)
+
+
+# /snark
+@commands.route(SNARK_COMMAND_ID, needs_api_key=True, timeout=SYNC_TIMEOUT_SECONDS)
+async def snark_command(user_text, thread_id, api_key, thread_obj):
+    guidance = "You are a snarky know-it-all that replies to any content "\
+                "by telling the actual truth of the matter. You usually "\
+                "start your reply with 'Actually...'"
+    return await process_chat_message(user_text, thread_id, api_key, guidance, thread_obj)
+
+
+# /poet
+@commands.route(POET_COMMAND_ID, needs_api_key=True, timeout=SYNC_TIMEOUT_SECONDS)
+async def poet_command(user_text, thread_id, api_key, thread_obj):
+    guidance = "You are an esteemed poet that replies to any request "\
+                "using a rhyming poem"
+    return await process_chat_message(user_text, thread_id, api_key, guidance, thread_obj)
+
+
+# /image
+@commands.route(IMAGE_COMMAND_ID, needs_api_key=True, timeout=SYNC_TIMEOUT_SECONDS)
+async def image_command(user_text, thread_id, api_key, thread_obj):
+    return await handle_image_command(user_text, api_key)
+
+
+# /api_key
+@commands.route(API_KEY_COMMAND_ID, timeout=SYNC_TIMEOUT_SECONDS)
+async def api_key_command(user_text, thread_id, api_key, thread_obj):
+    return dialog_util.api_key_dialog()
+
+
+# /story
+@commands.route(STORY_COMMAND_ID, needs_api_key=True, background=True, timeout=BACKGROUND_TIMEOUT_SECONDS)
+async def story_command(user_text, thread_id, api_key, thread_obj):
+    message_id_to_update = await story_util.send_generating_story_card_async(thread_id)
+    await async_util.to_thread(task_util.run_as_background_task, "handle_story_command", thread_id, user_text, message_id_to_update)
+    return {}
+
+
+async def reply_in_background(command_id, user_text, thread_id, reason):
+    """Finishes a command that can't reply before the deadline in the background.
+
+    Like /story, sends a "Generating..." placeholder and runs the command
+    in a task, which replaces the placeholder with the reply. That needs a
+    space to send messages to, so in rooms it only apologizes, and so does
+    a background command like /story that couldn't start in time.
+    """
+
+    # unknown command ids are handled by the route registered for None,
+    # and actions are only registered for route keys
+    command = commands.get(command_id)
 
-    else: 
-        return process_chat_message(user_text, thread_id)
+    logging.info("command %s finishing in the background: %s" % (command_id, reason))
+    metrics_util.increment(f"deadline.fallback.{reason}")
+    metrics_util.increment(f"deadline.fallback.command.{command.key}")
+    metrics_util.histogram("deadline.elapsed_s.fallback", deadline_util.current().elapsed())
 
+    if not thread_id or command.background:
+        return { "text" : DEADLINE_EXCEEDED_TEXT }
 
-def process_chat_message(user_text, thread_id, guidance=None):
+    message_id_to_update = await story_util.send_generating_story_card_async(thread_id)
+    await async_util.to_thread(task_util.run_as_background_task, f"command.{command.key}", thread_id, user_text, message_id_to_update)
+    return {}
+
+
+def finish_command(command_id, thread_id, user_text, message_id_to_update, api_key):
+    """Background action running a command for reply_in_background()."""
+
+    thread_obj = datastore_util.get_thread(thread_id)
+    response = async_util.run(commands.dispatch_async(command_id, user_text, thread_id, api_key, thread_obj))
+
+    # like /story, the placeholder gets the text and cards are sent after it
+    story_util.update_placeholder_card(thread_id, message_id_to_update, response.get("text", "Done!"))
+    if "cardsV2" in response:
+        story_util.send_asynchronous_chat_message(thread_id, {"cardsV2": response["cardsV2"]})
+
+
+# every command that replies synchronously can finish in the background
+for command in list(commands.routes.values()):
+    if command.needs_api_key and not command.background:
+        task_util.actions.add(f"command.{command.key}", functools.partial(finish_command, command.key),
+                              needs_api_key=True)
+
+
+async def process_chat_message(user_text, thread_id, api_key, guidance=None, thread_obj=None):
     """Processes message from user using ChatGPT.
 
-    Retrieves previous messages for context if not starting a new thread.
+    Uses previous messages from thread_obj for context if not starting a new thread.
     """
 
     messages = []
+    summary = None
 
     # if guidance provided, starting new conversation 
     if guidance:
         messages.append({"role": "system", "content" : guidance})
     else:
-        # otherwise get previous messages, because continuing converation
-        thread_obj = datastore_util.get_thread(thread_id)
-
+        # otherwise use previous messages, because continuing converation
         if thread_obj:
             messages = thread_obj.get_messages()
+            summary = thread_obj.summary
 
             if thread_obj.thread_type == "story":
-                message_id_to_update = story_util.send_generating_story_card(thread_id)
-                task_util.run_as_background_task("process_story_message", thread_id, user_text, message_id_to_update)
+                message_id_to_update = await story_util.send_generating_story_card_async(thread_id)
+                await async_util.to_thread(task_util.run_as_background_task, "process_story_message", thread_id, user_text, message_id_to_update)
                 return {}
     
     # add new message to list
-    messages.append( {"role": "user", "content": user_text} )
+    user_message = {"role": "user", "content": user_text}
+    messages.append(user_message)
+
+    # keep the guidance, the summary of older turns and the most recent
+    # turns within the token budget
+    prompt = await async_util.to_thread(history_util.build_prompt, messages, summary)
+
+    # streaming needs a space to send messages to, so only in direct messages
+    stream = STREAM_RESPONSES and thread_id
+
+    # a question without guidance or history may have been answered before
+    semantic_cache = None
+    embedding = None
+    gpt_response = None
+    if semantic_cache_util.ENABLED and len(prompt) == 1:
+        semantic_cache = await async_util.to_thread(semantic_cache_util.get_semantic_cache)
+        try:
+            gpt_response, embedding = await semantic_cache.lookup(user_text, api_key)
+        except openai.error.OpenAIError as e:
+            logging.warning("semantic cache lookup failed: %s" % e)
+            semantic_cache = None
+
+    # reply with a placeholder right away and stream the response into it
+    # after that, Chat would wait for the whole stream otherwise
+    if gpt_response is None and stream:
+        message_id = await story_util.send_generating_story_card_async(thread_id)
+        deferred_util.defer(stream_chat_reply, thread_id, message_id, prompt, api_key, messages,
+                            thread_obj, bool(guidance), semantic_cache, embedding)
+        return {}
 
     # get new gpt response
-    try:
-        gpt_response = gpt_util.get_gpt_response(messages)
-    except openai.error.OpenAIError as e:
-        return { "text" : str(e)}
+    if gpt_response is None:
+        try:
+            gpt_response = await gpt_util.get_gpt_response_async(prompt, api_key)
+        except openai.error.OpenAIError as e:
+            return { "text" : str(e)}
+
+        if semantic_cache:
+            await async_util.to_thread(semantic_cache.store, embedding, gpt_response)
 
-    # add new response to message history and store it
+    # append the new turn to the message history
     if thread_id:
-        messages.append( {"role": "assistant", "content": gpt_response} )
-        datastore_util.store_messages(thread_id, messages)
+        new_messages = [user_message, {"role": "assistant", "content": gpt_response}]
+        system_messages = messages[:-1]
+
+        if WRITE_BEHIND:
+            # deferred separately, so a failed enqueue doesn't retry the write
+            deferred_util.defer(write_chat_turn, thread_id, new_messages, system_messages,
+                                thread_obj, bool(guidance))
+            deferred_util.defer(enqueue_summary, thread_id, thread_obj, bool(guidance))
+        else:
+            await async_util.to_thread(store_chat_turn, thread_id, new_messages, system_messages,
+                                       thread_obj, bool(guidance))
 
     chat_response = { 
         "text" : gpt_response
@@ -182,21 +415,100 @@ def process_chat_message(user_text, thread_id, guidance=None):
 
     return chat_response
 
-def handle_image_command(image_prompt):
-    """Handles user prompt for creating an image."""
+def stream_chat_reply(thread_id, message_id, prompt, api_key, messages, thread_obj,
+                      new_conversation, semantic_cache=None, embedding=None):
+    """Streams the response to prompt into the placeholder message_id.
+
+    Deferred by process_chat_message(), so it runs after the event was
+    answered. Errors, including running out of STREAM_DEADLINE_SECONDS,
+    replace the placeholder. Once the response is complete, storing it
+    is deferred too, so a failed write doesn't stream it again.
+    """
 
     try:
-        image_url = gpt_util.create_image_with_prompt(image_prompt)
+        with deadline_util.deadline(STREAM_DEADLINE_SECONDS):
+            chunks = gpt_util.stream_gpt_response_async(prompt, api_key)
+            gpt_response = async_util.run(story_util.stream_chat_message_async(thread_id, chunks, message_id))
     except openai.error.OpenAIError as e:
-        return { "text" : str(e)}
+        story_util.update_placeholder_card(thread_id, message_id, str(e))
+        return
+    except deadline_util.DeadlineExceeded:
+        story_util.update_placeholder_card(thread_id, message_id, DEADLINE_EXCEEDED_TEXT)
+        return
+
+    if semantic_cache:
+        deferred_util.defer(semantic_cache.store, embedding, gpt_response)
+
+    new_messages = [messages[-1], {"role": "assistant", "content": gpt_response}]
+    deferred_util.defer(write_chat_turn, thread_id, new_messages, messages[:-1], thread_obj, new_conversation)
+    deferred_util.defer(enqueue_summary, thread_id, thread_obj, new_conversation)
+
+def store_chat_turn(thread_id, new_messages, system_messages, thread_obj, new_conversation):
+    """Stores a turn of a direct message conversation.
+
+    Appends to the conversation of thread_obj, or starts a new one with
+    system_messages. Enqueues summarization of older turns when needed.
+    """
+
+    write_chat_turn(thread_id, new_messages, system_messages, thread_obj, new_conversation)
+    enqueue_summary(thread_id, thread_obj, new_conversation)
+
+def write_chat_turn(thread_id, new_messages, system_messages, thread_obj, new_conversation):
+    """Writes a turn of a direct message conversation, see store_chat_turn().
+
+    A deferred retry reads the thread again, as the failed attempt may
+    have committed, and skips the write if the turn is already stored.
+    """
+
+    if deferred_util.is_retry():
+        thread_obj = datastore_util.get_thread(thread_id, use_cache=False)
+        if thread_obj and thread_obj.get_messages()[-len(new_messages):] == new_messages:
+            logging.info(f"turn of thread {thread_id} already stored, skipping")
+            return
+
+    if thread_obj and not new_conversation:
+        datastore_util.append_messages(thread_id, new_messages, thread_obj)
+    else:
+        datastore_util.start_conversation(thread_id, system_messages, new_messages, thread_obj=thread_obj)
+
+def enqueue_summary(thread_id, thread_obj, new_conversation):
+    """Compacts older turns into the summary in the background, when needed."""
+
+    if thread_obj and not new_conversation and history_util.needs_summary(thread_obj):
+        task_util.run_as_background_task("summarize_thread", thread_id, None, None)
+
+async def handle_image_command(image_prompt, api_key):
+    """Handles user prompt for creating an image.
+
+    The title only depends on the prompt, so it's generated while DALL-E
+    creates the image. If the title isn't ready within
+    IMAGE_TITLE_GRACE_SECONDS of the image, FALLBACK_IMAGE_TITLE is used.
+    """
 
     title_prompt = "The following prompt was given to DALL-E to create an "\
                   "image. Please come up with a witty title for the image. "\
                   "It should be no longer than 8 words: %s" % image_prompt
 
-
     messages=[ {"role": "user", "content": title_prompt} ]
-    image_title = gpt_util.get_gpt_response(messages)
+    title_task = asyncio.create_task(gpt_util.get_gpt_response_async(messages, api_key, use_cache=True))
+
+    try:
+        image_url = await gpt_util.create_image_with_prompt_async(image_prompt, api_key)
+    except openai.error.OpenAIError as e:
+        title_task.cancel()
+        return { "text" : str(e)}
+    except deadline_util.DeadlineExceeded:
+        title_task.cancel()
+        raise
+
+    try:
+        image_title = await asyncio.wait_for(title_task, IMAGE_TITLE_GRACE_SECONDS)
+    except (asyncio.TimeoutError, deadline_util.DeadlineExceeded):
+        logging.info("image title not ready, using fallback title")
+        image_title = FALLBACK_IMAGE_TITLE
+    except openai.error.OpenAIError as e:
+        logging.warning("image title failed: %s" % e)
+        image_title = FALLBACK_IMAGE_TITLE
 
     alt_text = "%s - Generated by DALL-E" % image_title
     card_id = "".join( [random.choice(string.ascii_letters + string.digits) for i in range(25)] )
@@ -0,0 +1,162 @@
+import bisect
+import logging
+import threading
+import time
+from collections import defaultdict
+
+# In-process counters, keyed by name. Like the summaries and histograms,
+# they count since the last export().
+counters = defaultdict(int)
+metrics_lock = threading.Lock()
+
+# Count, sum, min and max of observed values, keyed by name.
+summaries = {}
+
+# Counts of values per bucket, keyed by name.
+histograms = {}
+
+# Upper bounds of the buckets of a histogram, in seconds, unless it's given others.
+DEFAULT_BUCKETS = (0.5, 1, 2, 5, 10, 20, 30, 60)
+
+# Seconds between exports of the metrics to the log, see maybe_export().
+EXPORT_INTERVAL_SECONDS = 60
+_last_export = time.monotonic()
+
+
+def increment(name, value=1):
+    """Adds value to the counter called name."""
+
+    with metrics_lock:
+        counters[name] += value
+
+
+def get_counter(name):
+    return counters.get(name, 0)
+
+
+def observe(name, value):
+    """Records one observation of value for the summary called name."""
+
+    with metrics_lock:
+        summary = summaries.get(name)
+        if summary is None:
+            summaries[name] = {"count": 1, "sum": value, "min": value, "max": value}
+        else:
+            summary["count"] += 1
+            summary["sum"] += value
+            summary["min"] = min(summary["min"], value)
+            summary["max"] = max(summary["max"], value)
+
+
+def get_summary(name):
+    """Returns count, sum, min, max and mean of the observations for name."""
+
+    with metrics_lock:
+        summary = dict(summaries.get(name, {"count": 0, "sum": 0, "min": None, "max": None}))
+
+    summary["mean"] = summary["sum"] / summary["count"] if summary["count"] else None
+    return summary
+
+
+def histogram(name, value, buckets=DEFAULT_BUCKETS):
+    """Counts value in the histogram called name.
+
+    Each value is counted in the first bucket whose upper bound it doesn't
+    exceed, values above the last bound in an overflow bucket. The buckets
+    of a histogram are fixed by its first value.
+    """
+
+    with metrics_lock:
+        entry = histograms.get(name)
+        if entry is None:
+            entry = histograms[name] = {"buckets": tuple(buckets), "counts": [0] * (len(buckets) + 1)}
+
+        entry["counts"][bisect.bisect_left(entry["buckets"], value)] += 1
+
+
+def get_histogram(name):
+    """Returns the counts of the histogram called name, by bucket label like "<=5" or ">60"."""
+
+    with metrics_lock:
+        entry = histograms.get(name)
+        if entry is None:
+            return {}
+        buckets, counts = entry["buckets"], list(entry["counts"])
+
+    labels = [f"<={bound}" for bound in buckets] + [f">{buckets[-1]}"]
+    return dict(zip(labels, counts))
+
+
+def log_counters(prefix=""):
+    """Logs the current value of every counter whose name starts with prefix."""
+
+    with metrics_lock:
+        values = {name: value for name, value in counters.items() if name.startswith(prefix)}
+
+    logging.info(f"counters: {values}")
+
+
+def log_summaries(prefix=""):
+    """Logs every summary whose name starts with prefix."""
+
+    with metrics_lock:
+        names = [name for name in summaries if name.startswith(prefix)]
+
+    values = {name: get_summary(name) for name in names}
+    logging.info(f"summaries: {values}")
+
+
+def log_histograms(prefix=""):
+    """Logs every histogram whose name starts with prefix."""
+
+    with metrics_lock:
+        names = [name for name in histograms if name.startswith(prefix)]
+
+    values = {name: get_histogram(name) for name in names}
+    logging.info(f"histograms: {values}")
+
+
+def snapshot(reset=False):
+    """Returns {"counters": ..., "summaries": ..., "histograms": ...}, emptying them with reset."""
+
+    with metrics_lock:
+        counter_values = dict(counters)
+        summary_values = {name: dict(summary) for name, summary in summaries.items()}
+        histogram_values = {name: (entry["buckets"], list(entry["counts"])) for name, entry in histograms.items()}
+
+        if reset:
+            counters.clear()
+            summaries.clear()
+            histograms.clear()
+
+    for summary in summary_values.values():
+        summary["mean"] = summary["sum"] / summary["count"]
+
+    for name, (buckets, counts) in histogram_values.items():
+        labels = [f"<={bound}" for bound in buckets] + [f">{buckets[-1]}"]
+        histogram_values[name] = dict(zip(labels, counts))
+
+    return {"counters": counter_values, "summaries": summary_values, "histograms": histogram_values}
+
+
+def export():
+    """Logs the metrics as one structured log line and starts counting from zero.
+
+    The "metrics" field of the line holds the values since the previous
+    export, so log-based metrics in Cloud Logging can add them up across
+    instances.
+    """
+
+    global _last_export
+
+    _last_export = time.monotonic()
+    values = snapshot(reset=True)
+    if any(values.values()):
+        logging.info("metrics", extra={"json_fields": {"metrics": values}})
+
+
+def maybe_export():
+    """Calls export() if EXPORT_INTERVAL_SECONDS passed since the last one."""
+
+    if time.monotonic() - _last_export >= EXPORT_INTERVAL_SECONDS:
+        export()
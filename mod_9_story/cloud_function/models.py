@@ -1,12 +1,197 @@
+import json
+import time
+import zlib
+
 from google.cloud import ndb
 
+import metrics_util
+
+# Values shorter than this are stored uncompressed, zlib doesn't pay off.
+MIN_COMPRESS_BYTES = 256
+
+# Header versions of compressed properties.
+UNCOMPRESSED_VERSION = 0
+ZLIB_VERSION = 1
+
+
+class _CompressedProperty(ndb.BlobProperty):
+    """Base class for properties stored as a blob with a versioned header.
+
+    The stored value is a 2 byte magic, a version byte and the payload,
+    zlib compressed if it's at least MIN_COMPRESS_BYTES long. Values
+    without the header were stored before compression and are read as is.
+
+    Compression ratio and (de)serialization time are recorded in
+    metrics_util as "compression.ratio", "compression.serialize_ms"
+    and "compression.deserialize_ms".
+    """
+
+    MAGIC = b""
+
+    def _encode(self, value):
+        raise NotImplementedError
+
+    def _decode(self, data):
+        raise NotImplementedError
+
+    def _decode_legacy(self, value):
+        raise NotImplementedError
+
+    def _to_base_type(self, value):
+        start = time.perf_counter()
+
+        data = self._encode(value)
+        if len(data) >= MIN_COMPRESS_BYTES:
+            payload = self.MAGIC + bytes([ZLIB_VERSION]) + zlib.compress(data)
+            metrics_util.observe("compression.ratio", len(data) / len(payload))
+        else:
+            payload = self.MAGIC + bytes([UNCOMPRESSED_VERSION]) + data
+
+        metrics_util.observe("compression.serialize_ms", (time.perf_counter() - start) * 1000)
+        return payload
+
+    def _from_base_type(self, value):
+        if isinstance(value, str) or not value.startswith(self.MAGIC):
+            return self._decode_legacy(value)
+
+        start = time.perf_counter()
+
+        version = value[len(self.MAGIC)]
+        data = value[len(self.MAGIC) + 1:]
+        if version == ZLIB_VERSION:
+            data = zlib.decompress(data)
+        elif version != UNCOMPRESSED_VERSION:
+            raise ValueError("Unknown compression version %s" % version)
+
+        decoded = self._decode(data)
+        metrics_util.observe("compression.deserialize_ms", (time.perf_counter() - start) * 1000)
+        return decoded
+
+
+class CompressedJsonProperty(_CompressedProperty):
+    """A JsonProperty stored compressed. Reads values written by JsonProperty."""
+
+    MAGIC = b"\x00J"
+
+    def _encode(self, value):
+        return json.dumps(value, separators=(",", ":")).encode("utf-8")
+
+    def _decode(self, data):
+        return json.loads(data.decode("utf-8"))
+
+    def _decode_legacy(self, value):
+        if not isinstance(value, str):
+            value = value.decode("utf-8")
+        return json.loads(value)
+
+
+class CompressedTextProperty(_CompressedProperty):
+    """A TextProperty stored compressed. Reads values written by TextProperty."""
+
+    MAGIC = b"\x00T"
+
+    def _validate(self, value):
+        if not isinstance(value, str):
+            raise TypeError("Expected str, got %r" % (value,))
+
+    def _encode(self, value):
+        return value.encode("utf-8")
+
+    def _decode(self, data):
+        return data.decode("utf-8")
+
+    def _decode_legacy(self, value):
+        if not isinstance(value, str):
+            value = value.decode("utf-8")
+        return value
+
+
 class Thread(ndb.Model):
-    message_history = ndb.JsonProperty()
+    """A conversation with the bot.
+
+    Each turn is stored as its own Message entity under the Thread key,
+    numbered from 0 by message_count, so a turn is appended with one small
+    write instead of rewriting the whole history.
+
+    Turns before start_index belong to an earlier conversation or have
+    been folded into summary.
+    """
+
+    # legacy: the whole history, only read to migrate older threads
+    message_history = CompressedJsonProperty()
     timestamp = ndb.DateTimeProperty(auto_now_add=True)
     thread_type = ndb.StringProperty()
+    # running summary of older turns, before start_index
+    summary = ndb.TextProperty()
+    # guidance for the current conversation
+    system_messages = CompressedJsonProperty()
+    start_index = ndb.IntegerProperty(default=0)
+    message_count = ndb.IntegerProperty()
+    # incremented on every write, for optimistic concurrency
+    version = ndb.IntegerProperty(default=0)
 
     def get_messages(self):
-        return self.message_history['messages']
+        """Returns the system messages followed by the turns loaded with the thread."""
+
+        return (self.system_messages or []) + getattr(self, "_turns", [])
+
+    def set_turns(self, turns):
+        self._turns = turns
+
+    def needs_migration(self):
+        return self.message_count is None
+
+    def migrate_message_history(self):
+        """Moves a legacy message_history into Message entities.
+
+        Returns the entities to put(), including this thread.
+        """
+
+        messages = self.message_history['messages'] if self.message_history else []
+
+        system_count = 0
+        while system_count < len(messages) and messages[system_count]["role"] == "system":
+            system_count += 1
+
+        turns = messages[system_count:]
+        entities = [Message.for_turn(self.key, index, turn) for index, turn in enumerate(turns)]
+
+        self.system_messages = messages[:system_count]
+        self.start_index = 0
+        self.message_count = len(turns)
+        self.message_history = None
+        self.set_turns(turns)
+
+        return [self] + entities
+
+
+class Message(ndb.Model):
+    """One turn of a Thread, keyed by its index within the thread."""
+
+    role = ndb.StringProperty()
+    content = CompressedTextProperty()
+
+    @classmethod
+    def key_for(cls, thread_key, index):
+        # ndb ids can't be 0
+        return ndb.Key(cls, index + 1, parent=thread_key)
+
+    @classmethod
+    def for_turn(cls, thread_key, index, turn):
+        return cls(key=cls.key_for(thread_key, index), role=turn["role"], content=turn["content"])
+
+    def index(self):
+        return self.key.id() - 1
+
+    def as_turn(self):
+        return {"role": self.role, "content": self.content}
+
+
+class CachedResponse(ndb.Model):
+    """A ChatGPT response shared by instances, keyed by a hash of its prompt."""
+
+    response = ndb.TextProperty()
+    expires_at = ndb.DateTimeProperty()
 
 
 class User(ndb.Model):
@@ -0,0 +1,110 @@
+import datetime
+import hashlib
+import json
+import logging
+
+import async_util
+import datastore_util
+import metrics_util
+from cache_util import LRUCache
+from models import CachedResponse
+
+# Cache responses to prompts marked as cacheable, such as image and story
+# titles. Off by default: with it on, a repeated prompt gets the same
+# response instead of a new one.
+ENABLED = False
+
+# Also share cached responses between instances through Datastore.
+SHARED = False
+
+# Seconds a cached response is used for.
+CACHE_TTL = 24 * 60 * 60
+
+# Cached responses in this instance by cache_key().
+response_cache = LRUCache(maxsize=512, ttl=CACHE_TTL)
+
+# Hits and misses are counted in metrics_util as "prompt_cache.hit.local",
+# "prompt_cache.hit.shared" and "prompt_cache.miss".
+
+def cache_key(model, temperature, messages):
+    """Returns the cache key for a prompt: a hash of everything that shapes the response."""
+
+    prompt = json.dumps([model, temperature, messages], sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(prompt.encode("utf-8")).hexdigest()
+
+def get_response(key):
+    """Returns the cached response for key, or None."""
+
+    response = response_cache.get(key)
+    if response is not None:
+        metrics_util.increment("prompt_cache.hit.local")
+        return response
+
+    if SHARED:
+        response = _get_shared(key)
+        if response is not None:
+            metrics_util.increment("prompt_cache.hit.shared")
+            response_cache.set(key, response)
+            return response
+
+    metrics_util.increment("prompt_cache.miss")
+    return None
+
+async def get_response_async(key):
+    """Async version of get_response(), reading Datastore on a blocking thread."""
+
+    response = response_cache.get(key)
+    if response is not None:
+        metrics_util.increment("prompt_cache.hit.local")
+        return response
+
+    if SHARED:
+        response = await async_util.to_thread(_get_shared, key)
+        if response is not None:
+            metrics_util.increment("prompt_cache.hit.shared")
+            response_cache.set(key, response)
+            return response
+
+    metrics_util.increment("prompt_cache.miss")
+    return None
+
+def store_response(key, response):
+    """Caches response for key."""
+
+    response_cache.set(key, response)
+
+    if SHARED:
+        _set_shared(key, response)
+
+async def store_response_async(key, response):
+    """Async version of store_response()."""
+
+    response_cache.set(key, response)
+
+    if SHARED:
+        await async_util.to_thread(_set_shared, key, response)
+
+def _get_shared(key):
+    try:
+        with datastore_util.ndb_context():
+            cached = CachedResponse.get_by_id(key)
+    except Exception as e:
+        # the cache is only an optimization, a failed read is a miss
+        logging.warning(f"shared prompt cache read failed: {e}")
+        return None
+
+    if not cached or cached.expires_at <= datetime.datetime.utcnow():
+        return None
+
+    return cached.response
+
+def _set_shared(key, response):
+    # Datastore doesn't delete expired entities, they are ignored on read.
+    # A TTL policy on expires_at (Firestore in Datastore mode) removes them.
+    expires_at = datetime.datetime.utcnow() + datetime.timedelta(seconds=CACHE_TTL)
+
+    try:
+        with datastore_util.ndb_context():
+            CachedResponse(id=key, response=response, expires_at=expires_at).put()
+    except Exception as e:
+        logging.warning(f"shared prompt cache write failed: {e}")
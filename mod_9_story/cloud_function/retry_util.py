@@ -0,0 +1,236 @@
+import asyncio
+import logging
+import random
+import threading
+import time
+
+import openai
+
+import deadline_util
+import metrics_util
+from cache_util import LRUCache
+
+# Attempts per call, including the first.
+MAX_ATTEMPTS = 4
+
+# Retries wait a random time between 0 and BASE_DELAY_SECONDS * 2 ** retry,
+# at most MAX_DELAY_SECONDS, or longer if OpenAI asks so with Retry-After.
+BASE_DELAY_SECONDS = 0.5
+MAX_DELAY_SECONDS = 8
+
+# After FAILURE_THRESHOLD failed attempts in a row with the same API key,
+# calls with it fail right away for OPEN_SECONDS. Then one call is let
+# through, and its result decides whether calls resume.
+FAILURE_THRESHOLD = 5
+OPEN_SECONDS = 30
+
+# Maximum number of API keys with a circuit breaker, the least recently
+# used is forgotten.
+MAX_BREAKERS = 1024
+
+# Retries, hedged requests and fast failures are counted in metrics_util
+# as "openai.retry", "openai.hedge", "openai.hedge.won" and
+# "openai.circuit_open".
+
+
+class CircuitOpenError(openai.error.OpenAIError):
+    """Raised instead of calling OpenAI while its calls with an API key keep failing."""
+
+
+def is_retryable(error):
+    """Returns True if a call that raised error may succeed when made again."""
+
+    if isinstance(error, openai.error.RateLimitError):
+        # running out of quota isn't fixed by waiting
+        return error.code != "insufficient_quota"
+
+    if isinstance(error, openai.error.APIError):
+        return error.http_status is None or error.http_status >= 500
+
+    return isinstance(error, (openai.error.ServiceUnavailableError, openai.error.APIConnectionError,
+                              openai.error.Timeout, openai.error.TryAgain))
+
+
+def retry_delay(error, retry):
+    """Returns the seconds to wait before retry number retry, counting from 0, after error."""
+
+    delay = random.uniform(0, min(MAX_DELAY_SECONDS, BASE_DELAY_SECONDS * 2 ** retry))
+
+    try:
+        retry_after = float(error.headers.get("retry-after"))
+    except (AttributeError, TypeError, ValueError):
+        retry_after = None
+
+    if retry_after is not None:
+        delay = max(delay, retry_after)
+
+    return delay
+
+
+class CircuitBreaker:
+    """Tracks the failures of calls with an API key, see FAILURE_THRESHOLD."""
+
+    def __init__(self, failure_threshold, open_seconds):
+        self.failure_threshold = failure_threshold
+        self.open_seconds = open_seconds
+        self.failures = 0
+        self.opened_at = None
+        self.trial_running = False
+        self.lock = threading.Lock()
+
+    def before_call(self):
+        """Raises CircuitOpenError if the call shouldn't be made."""
+
+        with self.lock:
+            if self.opened_at is None:
+                return
+
+            if not self.trial_running and time.monotonic() - self.opened_at >= self.open_seconds:
+                self.trial_running = True
+                return
+
+        metrics_util.increment("openai.circuit_open")
+        raise CircuitOpenError("OpenAI is having trouble right now, please try again in a minute.")
+
+    def record(self, error=None):
+        """Records the outcome of a call, error is what it raised if anything.
+
+        Only transient errors count as failures. Other errors mean OpenAI
+        answered, and errors not from OpenAI, like running out of time,
+        don't tell either way.
+        """
+
+        with self.lock:
+            if error is not None and is_retryable(error):
+                self.failures += 1
+                if self.trial_running or self.failures >= self.failure_threshold:
+                    if self.opened_at is None:
+                        logging.warning("OpenAI calls failing, pausing them for %ss" % self.open_seconds)
+                    self.opened_at = time.monotonic()
+
+            elif error is None or isinstance(error, openai.error.OpenAIError):
+                self.failures = 0
+                self.opened_at = None
+
+            self.trial_running = False
+
+
+breakers = LRUCache(maxsize=MAX_BREAKERS)
+breakers_lock = threading.Lock()
+
+def get_breaker(api_key):
+    """Returns the CircuitBreaker of api_key, None for the global openai.api_key."""
+
+    with breakers_lock:
+        breaker = breakers.get(api_key)
+        if breaker is None:
+            breaker = CircuitBreaker(FAILURE_THRESHOLD, OPEN_SECONDS)
+            breakers.set(api_key, breaker)
+
+    return breaker
+
+
+def _check_retry(error, retry):
+    """Returns the delay before retrying after error, or raises if it can't be retried.
+
+    Retries that couldn't finish before the request's deadline raise
+    deadline_util.DeadlineExceeded, so the caller can reply some other way.
+    """
+
+    if not is_retryable(error) or retry + 1 >= MAX_ATTEMPTS:
+        raise error
+
+    delay = retry_delay(error, retry)
+
+    deadline = deadline_util.current()
+    if deadline and delay >= deadline.remaining():
+        raise deadline_util.DeadlineExceeded("No time left to retry OpenAI") from error
+
+    logging.info("retrying OpenAI call in %.2fs after: %s" % (delay, error))
+    metrics_util.increment("openai.retry")
+    return delay
+
+
+def call(func, api_key=None):
+    """Returns func(), retrying transient OpenAI errors with backoff.
+
+    func makes one request to OpenAI with api_key. It's called again for
+    every attempt, so timeouts can be computed from the time left.
+
+    Raises: openai.error.OpenAIError, deadline_util.DeadlineExceeded
+    """
+
+    breaker = get_breaker(api_key)
+
+    for retry in range(MAX_ATTEMPTS):
+        breaker.before_call()
+        try:
+            result = func()
+        except BaseException as e:
+            breaker.record(e)
+            if not isinstance(e, openai.error.OpenAIError):
+                raise
+            time.sleep(_check_retry(e, retry))
+        else:
+            breaker.record()
+            return result
+
+
+async def call_async(func, api_key=None, hedge_after=None):
+    """Async version of call(), func returns a coroutine.
+
+    With hedge_after, a second request is made when the first hasn't
+    finished after hedge_after seconds, and the first to succeed is used.
+    This shortens the slowest calls at the cost of paying for some twice.
+
+    Raises: openai.error.OpenAIError, deadline_util.DeadlineExceeded
+    """
+
+    breaker = get_breaker(api_key)
+
+    for retry in range(MAX_ATTEMPTS):
+        breaker.before_call()
+        try:
+            result = await _hedged(func, hedge_after)
+        except BaseException as e:
+            breaker.record(e)
+            if not isinstance(e, openai.error.OpenAIError):
+                raise
+            await asyncio.sleep(_check_retry(e, retry))
+        else:
+            breaker.record()
+            return result
+
+
+async def _hedged(func, hedge_after):
+    """Awaits func(), hedged after hedge_after seconds if it's not None."""
+
+    # only hedge when the second request has time to finish
+    deadline = deadline_util.current()
+    if hedge_after is None or (deadline and deadline.remaining() <= hedge_after):
+        return await func()
+
+    first = asyncio.ensure_future(func())
+    pending = {first}
+    try:
+        # a caller cancelled while waiting cancels the requests in finally
+        done, pending = await asyncio.wait(pending, timeout=hedge_after)
+        if done:
+            return first.result()
+
+        metrics_util.increment("openai.hedge")
+        second = asyncio.ensure_future(func())
+        pending = {first, second}
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                error = task.exception()
+                if error is None:
+                    if task is second:
+                        metrics_util.increment("openai.hedge.won")
+                    return task.result()
+
+        raise error
+    finally:
+        for task in pending:
+            task.cancel()
@@ -0,0 +1,115 @@
+import asyncio
+import contextlib
+import logging
+import threading
+import time
+
+import metrics_util
+
+
+class Route:
+    """A registered handler and how it's meant to run.
+
+    background: the handler only starts the work, e.g. sends a placeholder
+        message and creates a task, and the result is sent later.
+    timeout: seconds the handler should respond within. Slower calls are
+        logged and counted, they aren't interrupted.
+    needs_api_key: the handler calls OpenAI with the user's API key.
+    max_concurrent: maximum number of calls of the handler running at
+        once in the instance, further calls wait. None for no limit.
+    """
+
+    def __init__(self, key, handler, background=False, timeout=None, needs_api_key=False, max_concurrent=None):
+        self.key = key
+        self.handler = handler
+        self.background = background
+        self.timeout = timeout
+        self.needs_api_key = needs_api_key
+        self.max_concurrent = max_concurrent
+
+        self._limit = None
+        if max_concurrent:
+            if asyncio.iscoroutinefunction(handler):
+                self._limit = asyncio.Semaphore(max_concurrent)
+            else:
+                self._limit = threading.BoundedSemaphore(max_concurrent)
+
+
+class Router:
+    """Handlers looked up by key, such as an event type or a slash command id.
+
+    Every call through dispatch() or dispatch_async() is timed in
+    metrics_util as "route.<name>.<key>.ms". Calls slower than their
+    route's timeout are counted as "route.<name>.<key>.over_timeout".
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.routes = {}
+
+    def add(self, key, handler, **metadata):
+        """Registers handler for key, with the metadata of Route."""
+
+        if key in self.routes:
+            raise ValueError(f"{self.name} {key!r} already has a handler")
+
+        self.routes[key] = Route(key, handler, **metadata)
+        return handler
+
+    def route(self, *keys, **metadata):
+        """Decorator that registers the function for each of keys."""
+
+        def decorator(handler):
+            for key in keys:
+                self.add(key, handler, **metadata)
+            return handler
+
+        return decorator
+
+    def get(self, key):
+        """Returns the Route for key, or the one registered for None if there's none."""
+
+        route = self.routes.get(key)
+        if route is None:
+            route = self.routes.get(None)
+
+        return route
+
+    def dispatch(self, key, *args, default=None, **kwargs):
+        """Calls the handler for key with args, returns default if there's none."""
+
+        route = self.get(key)
+        if route is None:
+            logging.info(f"no {self.name} handler for {key!r}")
+            return default
+
+        start = time.perf_counter()
+        try:
+            with route._limit or contextlib.nullcontext():
+                return route.handler(*args, **kwargs)
+        finally:
+            self._record(route, time.perf_counter() - start)
+
+    async def dispatch_async(self, key, *args, default=None, **kwargs):
+        """Awaits the coroutine handler for key with args, returns default if there's none."""
+
+        route = self.get(key)
+        if route is None:
+            logging.info(f"no {self.name} handler for {key!r}")
+            return default
+
+        start = time.perf_counter()
+        try:
+            async with route._limit or contextlib.nullcontext():
+                return await route.handler(*args, **kwargs)
+        finally:
+            self._record(route, time.perf_counter() - start)
+
+    def _record(self, route, seconds):
+        metric = f"route.{self.name}.{route.key}"
+        metrics_util.observe(f"{metric}.ms", seconds * 1000)
+
+        if route.timeout is not None and seconds > route.timeout:
+            metrics_util.increment(f"{metric}.over_timeout")
+            logging.warning(f"{self.name} {route.key!r} took {seconds:.2f}s, "
+                            f"more than its {route.timeout}s timeout")
@@ -0,0 +1,141 @@
+import asyncio
+import contextlib
+import logging
+import os
+import threading
+
+import openai
+
+import deadline_util
+import metrics_util
+import retry_util
+
+# Answer questions similar to one answered before with the earlier answer.
+# Off by default: every cache miss pays for an embedding call.
+ENABLED = False
+
+EMBEDDING_MODEL = "text-embedding-ada-002"
+
+# Minimum cosine similarity between two questions for them to share an answer.
+SIMILARITY_THRESHOLD = 0.95
+
+# Maximum number of answers kept, the least recently used is evicted.
+MAX_ENTRIES = 1000
+
+# File the index is saved to every SAVE_EVERY new answers and loaded from
+# on first use. On Cloud Functions only /tmp is writable, and it's kept
+# for the lifetime of the instance. None keeps the index in memory only.
+CACHE_FILE = "/tmp/semantic_cache.npz"
+SAVE_EVERY = 20
+
+# Hits and misses are counted in metrics_util as "semantic_cache.hit" and
+# "semantic_cache.miss", and the best similarity of every lookup is
+# observed as "semantic_cache.similarity".
+
+
+@contextlib.contextmanager
+def _within_deadline():
+    """Raises DeadlineExceeded for timeouts caused by the request's deadline."""
+
+    try:
+        yield
+    except (openai.error.Timeout, asyncio.TimeoutError) as e:
+        if deadline_util.expired():
+            raise deadline_util.DeadlineExceeded("OpenAI didn't respond before the deadline") from e
+        raise
+
+
+async def get_embedding(text, api_key=None):
+    """Returns the embedding of text, using OpenAI.
+
+    Like the calls of gpt_util, it times out at the request's deadline and
+    transient errors are retried, see retry_util.
+
+    Raises: openai.error.OpenAIError, deadline_util.DeadlineExceeded
+    """
+
+    async def request():
+        with _within_deadline():
+            return await openai.Embedding.acreate(
+                model=EMBEDDING_MODEL,
+                input=text,
+                api_key=api_key,
+                request_timeout=deadline_util.timeout()
+            )
+
+    response = await retry_util.call_async(request, api_key)
+
+    return response['data'][0]['embedding']
+
+
+class SemanticCache:
+    """Answers cached by the meaning of their question.
+
+    embed is an async function of (text, api_key) returning an embedding,
+    get_embedding() by default. Pass another one to use the cache offline.
+    """
+
+    def __init__(self, embed=get_embedding, threshold=SIMILARITY_THRESHOLD,
+                 max_entries=MAX_ENTRIES, path=CACHE_FILE):
+        # imported here, numpy is only needed once the cache is enabled
+        from vector_index import VectorIndex
+
+        self.embed = embed
+        self.threshold = threshold
+        self.path = path
+        self.unsaved = 0
+
+        self.index = VectorIndex(max_entries)
+        if path and os.path.exists(path):
+            try:
+                self.index = VectorIndex.load(path, max_entries)
+            except Exception as e:
+                logging.warning(f"semantic cache at {path} not loaded: {e}")
+
+    async def lookup(self, text, api_key=None):
+        """Returns (response, embedding) for text.
+
+        response is None on a miss. Pass embedding to store() to cache the
+        answer to text without embedding it again.
+        """
+
+        embedding = await self.embed(text, api_key)
+        response, similarity = self.index.search(embedding, self.threshold)
+
+        if len(self.index):
+            metrics_util.observe("semantic_cache.similarity", similarity)
+
+        if response is not None and similarity >= self.threshold:
+            metrics_util.increment("semantic_cache.hit")
+            return response, embedding
+
+        metrics_util.increment("semantic_cache.miss")
+        return None, embedding
+
+    def store(self, embedding, response):
+        """Caches response for the question with embedding. Blocking when saving."""
+
+        self.index.add(embedding, response)
+        self.unsaved += 1
+
+        if self.path and self.unsaved >= SAVE_EVERY:
+            self.unsaved = 0
+            try:
+                self.index.save(self.path)
+            except Exception as e:
+                logging.warning(f"semantic cache not saved to {self.path}: {e}")
+
+
+_semantic_cache = None
+_semantic_cache_lock = threading.Lock()
+
+def get_semantic_cache():
+    """Returns the instance's SemanticCache, loading it on first use."""
+
+    global _semantic_cache
+
+    with _semantic_cache_lock:
+        if _semantic_cache is None:
+            _semantic_cache = SemanticCache()
+
+    return _semantic_cache
@@ -1,14 +1,45 @@
 import logging
+import threading
+import time
+import aiohttp
 import google.auth
-from apiclient.discovery import build
+import openai
+from google.auth.transport.requests import Request
 
+import async_util
+import deadline_util
 import gpt_util
+import http_util
 import datastore_util
+from timing_util import StageTimer
 
-def handle_story_command(thread_id, user_text, message_id_to_update):
-    """Handles user prompt for a new story."""
+# Scopes the bot needs to send messages with the Chat REST API.
+CHAT_SCOPES = ['https://www.googleapis.com/auth/chat.bot']
 
-    title_widget = create_story_title(user_text)
+# Base url of the Chat REST API, used by the async message functions.
+CHAT_API_URL = 'https://chat.googleapis.com/v1'
+
+# Chat API client and credentials, created once per instance by
+# get_chat_client() and get_chat_credentials().
+chat_client = None
+chat_credentials = None
+chat_client_lock = threading.Lock()
+
+# Title used when the story title can't be generated.
+FALLBACK_STORY_TITLE = "Your story"
+
+# Minimum seconds between updates of a message while a response streams in.
+STREAM_UPDATE_INTERVAL_SECONDS = 0.75
+
+def handle_story_command(thread_id, user_text, message_id_to_update, api_key=None):
+    """Handles user prompt for a new story.
+
+    The title only depends on the topic, so it's generated on the
+    gpt_util.executor while this thread generates the first chapter.
+    """
+
+    timer = StageTimer("handle_story_command")
+    title_future = gpt_util.executor.submit(create_story_title, user_text, timer, api_key)
 
     story_prompt = "Write the first section of a story in the style of a "\
         "'choose your own adventure book'. Each section should be 3 "\
@@ -16,9 +47,17 @@ def handle_story_command(thread_id, user_text, message_id_to_update):
         "The story should be based on the following suggestion: %s" % user_text
 
     messages = [{"role": "user", "content": story_prompt}]
-    chapter_widgets, messages = create_story_chapter(messages)
+    chapter_widgets, messages = create_story_chapter(messages, timer, api_key)
+
+    with timer.stage("store_messages"):
+        datastore_util.start_conversation(thread_id, [], messages, "story")
 
-    datastore_util.store_messages(thread_id, messages, "story")
+    with timer.stage("wait_for_title"):
+        try:
+            title_widget = title_future.result()
+        except openai.error.OpenAIError as e:
+            logging.warning("story title failed: %s" % e)
+            title_widget = make_title_widget(FALLBACK_STORY_TITLE)
 
     all_widgets = [title_widget]
     all_widgets.extend(chapter_widgets)
@@ -33,20 +72,31 @@ def handle_story_command(thread_id, user_text, message_id_to_update):
     }
 
     placeholder_text = "A custom story just for you..."
-    update_placeholder_card(thread_id, message_id_to_update, placeholder_text)
+    with timer.stage("send_messages"):
+        update_placeholder_card(thread_id, message_id_to_update, placeholder_text)
+        send_asynchronous_chat_message(thread_id, cards)
 
-    send_asynchronous_chat_message(thread_id, cards)
+    timer.log()
 
 
 
-def create_story_title(user_text):
+def create_story_title(user_text, timer=None, api_key=None):
     """Uses ChatGPT to create title of story based on topic provided."""
 
+    timer = timer or StageTimer("create_story_title")
+
     prompt = "The following text was given as the topic of a story. Please "\
         "come up with a witty title for the story. It should be no longer "\
         "than 8 words: %s" % user_text
 
-    story_title = gpt_util.get_gpt_response([{"role": "user", "content": prompt}])
+    with timer.stage("title"):
+        story_title = gpt_util.get_gpt_response([{"role": "user", "content": prompt}], api_key, use_cache=True)
+
+    return make_title_widget(story_title)
+
+
+def make_title_widget(story_title):
+    """Returns the widget showing the title of a story."""
 
     title_widget = {
         "decoratedText": {
@@ -54,18 +104,24 @@ def create_story_title(user_text):
             "wrapText": True
         }
     }
-    
+
     return title_widget
 
 
-def create_story_chapter(messages):
+def create_story_chapter(messages, timer=None, api_key=None):
     """Creates a card for a story chapter.
     
     Gets new chapter text using provided messages. Generates an image
     related to the new chapter text.
+
+    Each stage depends on the one before it, so they run in order on
+    the calling thread. Durations are recorded on timer if provided.
     """
 
-    chapter_text = gpt_util.get_gpt_response(messages)
+    timer = timer or StageTimer("create_story_chapter")
+
+    with timer.stage("chapter_text"):
+        chapter_text = gpt_util.get_gpt_response(messages, api_key)
     chapter_widget = {
         "textParagraph": {
             "text": chapter_text
@@ -81,12 +137,14 @@ def create_story_chapter(messages):
             "illustrated image for this most recent part of the story:\r\n %s" % chapter_text
     
     image_messages.append({"role": "user", "content": prompt})
-    image_prompt = gpt_util.get_gpt_response(image_messages)
+    with timer.stage("image_prompt"):
+        image_prompt = gpt_util.get_gpt_response(image_messages, api_key)
     image_prompt = f"{image_prompt}. This should be an illustration "\
                     "for a children's book in the style of an acrylic painting."
     logging.info("Story chapter image prompt: %s" % image_prompt )
 
-    image_url = gpt_util.create_image_with_prompt(image_prompt)
+    with timer.stage("image"):
+        image_url = gpt_util.create_image_with_prompt(image_prompt, api_key)
     image_widget = {
         "image": {
             "imageUrl": image_url
@@ -110,20 +168,25 @@ def create_story_chapter(messages):
     return widgets, messages
 
 
-def process_story_message(thread_id, user_text, message_id_to_update):
+def process_story_message(thread_id, user_text, message_id_to_update, api_key=None):
     """Processes a response from user for the next path of the story."""
 
-    thread_obj = datastore_util.get_thread(thread_id)
-    messages = thread_obj.get_messages()
+    timer = StageTimer("process_story_message")
+
+    with timer.stage("get_thread"):
+        thread_obj = datastore_util.get_thread(thread_id)
+        messages = thread_obj.get_messages()
 
     # wrap up the story after 4 choices
     if len(messages) == 8:
         user_text = "End the story with this option: %s" % user_text
 
     messages.append({"role": "user", "content": user_text})
-    chapter_widgets, messages = create_story_chapter(messages)
+    chapter_widgets, messages = create_story_chapter(messages, timer, api_key)
 
-    datastore_util.store_messages(thread_id, messages, "story")
+    # only the user's choice and the new chapter are written
+    with timer.stage("store_messages"):
+        datastore_util.append_messages(thread_id, messages[-2:], thread_obj)
 
     cards = {
         "cardsV2": [
@@ -136,9 +199,11 @@ def process_story_message(thread_id, user_text, message_id_to_update):
 
     chapter_number = len(messages) // 2
     placeholder_text = f"Chapter {chapter_number}"
-    update_placeholder_card(thread_id, message_id_to_update, placeholder_text)
+    with timer.stage("send_messages"):
+        update_placeholder_card(thread_id, message_id_to_update, placeholder_text)
+        send_asynchronous_chat_message(thread_id, cards)
 
-    send_asynchronous_chat_message(thread_id, cards)
+    timer.log()
 
 
 def send_generating_story_card(thread_id):
@@ -152,6 +217,15 @@ def send_generating_story_card(thread_id):
     return message_id
 
 
+async def send_generating_story_card_async(thread_id):
+    """Async version of send_generating_story_card()."""
+
+    body = { "text" : "Generating..."}
+    message_id = await send_asynchronous_chat_message_async(thread_id, body)
+
+    return message_id
+
+
 def update_placeholder_card(thread_id, message_id, content):
     """Updates the "Generating story..." placeholder card with new text."""
 
@@ -160,6 +234,65 @@ def update_placeholder_card(thread_id, message_id, content):
 
 
 
+def stream_chat_message(thread_id, chunks):
+    """Sends text to a space as it's generated.
+
+    Sends a "Generating..." placeholder, then edits it with the text
+    received from chunks so far, at most once every
+    STREAM_UPDATE_INTERVAL_SECONDS, and once more with the full text.
+
+    Returns the full text.
+    """
+
+    message_id = send_generating_story_card(thread_id)
+
+    text = ""
+    sent_text = ""
+    last_update = time.monotonic()
+
+    for chunk in chunks:
+        text += chunk
+
+        if time.monotonic() - last_update >= STREAM_UPDATE_INTERVAL_SECONDS:
+            update_placeholder_card(thread_id, message_id, text)
+            sent_text = text
+            last_update = time.monotonic()
+
+    if text != sent_text:
+        update_placeholder_card(thread_id, message_id, text)
+
+    return text
+
+
+async def stream_chat_message_async(thread_id, chunks, message_id=None):
+    """Async version of stream_chat_message(), chunks is an async iterator.
+
+    Edits the placeholder message_id if it was already sent. The edits
+    are sent with the shared aiohttp session, so a streamed reply doesn't
+    hold a thread of async_util.blocking_executor.
+    """
+
+    if not message_id:
+        message_id = await send_generating_story_card_async(thread_id)
+
+    text = ""
+    sent_text = ""
+    last_update = time.monotonic()
+
+    async for chunk in chunks:
+        text += chunk
+
+        if time.monotonic() - last_update >= STREAM_UPDATE_INTERVAL_SECONDS:
+            await send_asynchronous_chat_message_async(thread_id, { "text" : text }, message_id=message_id)
+            sent_text = text
+            last_update = time.monotonic()
+
+    if text != sent_text:
+        await send_asynchronous_chat_message_async(thread_id, { "text" : text }, message_id=message_id)
+
+    return text
+
+
 def send_asynchronous_chat_message(thread_id, body, message_id=None):
     """Send a chat message to a space asynchronously.
 
@@ -174,9 +307,11 @@ def send_asynchronous_chat_message(thread_id, body, message_id=None):
     space_id = thread_id.split("-")[1]
     space_name = f"spaces/{space_id}"
 
-    SCOPES = ['https://www.googleapis.com/auth/chat.bot']
-    credentials, project = google.auth.default(scopes=SCOPES)
-    chat = build('chat', 'v1', credentials=credentials)
+    chat = get_chat_client()
+
+    # requests are executed on this thread's transport, which refreshes
+    # the shared credentials only when they have expired
+    http = http_util.get_http(get_chat_credentials())
 
     # update content of an existing message
     if message_id:
@@ -184,13 +319,86 @@ def send_asynchronous_chat_message(thread_id, body, message_id=None):
             name=message_id,
             updateMask='text',
             body=body
-        ).execute()
+        ).execute(http=http)
 
     # create a new message
     else:
         response_obj = chat.spaces().messages().create(
             parent=space_name,
             body=body
-        ).execute()
+        ).execute(http=http)
+
+    return response_obj.get("name")
+
+
+def get_chat_client():
+    """Returns the Chat API client, creating it on first use.
+
+    The client is built from the static discovery document bundled with
+    google-api-python-client, so it's parsed once per instance and never
+    fetched over the network.
+    """
+
+    global chat_client
+
+    credentials = get_chat_credentials()
+
+    with chat_client_lock:
+        if not chat_client:
+            # imported here, most events reply without the Chat API client
+            from googleapiclient.discovery import build
+            chat_client = build('chat', 'v1', credentials=credentials,
+                                static_discovery=True, cache_discovery=False)
+
+    return chat_client
+
+
+def get_chat_credentials():
+    """Returns the credentials used to call the Chat API, loading them on first use."""
+
+    global chat_credentials
+
+    with chat_client_lock:
+        if not chat_credentials:
+            chat_credentials, project = google.auth.default(scopes=CHAT_SCOPES)
+
+    return chat_credentials
+
+
+async def send_asynchronous_chat_message_async(thread_id, body, message_id=None):
+    """Async version of send_asynchronous_chat_message().
+
+    Calls the Chat REST API directly with the shared aiohttp session,
+    so sending a message doesn't tie up a thread.
+    """
+
+    space_id = thread_id.split("-")[1]
+    space_name = f"spaces/{space_id}"
+
+    credentials = await async_util.to_thread(get_chat_credentials)
+    if not credentials.valid:
+        await async_util.to_thread(credentials.refresh, Request(session=http_util.session))
+
+    headers = {"Authorization": f"Bearer {credentials.token}"}
+    session = async_util.get_session()
+
+    # Messages sent during a request, like the placeholder of a reply that
+    # ran out of time, may use the time reserved before its deadline.
+    timeout = aiohttp.ClientTimeout(
+        total=deadline_util.timeout(http_util.REQUEST_TIMEOUT, include_reserve=True))
+
+    # update content of an existing message
+    if message_id:
+        request = session.put(f"{CHAT_API_URL}/{message_id}", params={"updateMask": "text"},
+                              json=body, headers=headers, timeout=timeout)
+
+    # create a new message
+    else:
+        request = session.post(f"{CHAT_API_URL}/{space_name}/messages",
+                               json=body, headers=headers, timeout=timeout)
+
+    async with request as response:
+        response.raise_for_status()
+        response_obj = await response.json()
 
     return response_obj.get("name")
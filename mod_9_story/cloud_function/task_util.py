@@ -1,10 +1,13 @@
+import itertools
 import logging
 import json
-from google.cloud import tasks_v2
-import openai
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait
 import story_util
 import auth_util
 import datastore_util
+import history_util
+import router_util
 
 # TODO: Update with Google Cloud ProjectID
 PROJECT_ID = "XXXXXXX"
@@ -16,10 +19,139 @@ SERVICE_ACCOUNT_EMAIL = "xxxxxxxxxxxxxxx"
 TRIGGER_URL = "xxxxxxxxxxxxx"
 
 
+# Where background tasks run, a key of task_backends:
+#   "cloud_tasks": a Cloud Tasks task posts the action back to handle_chat.
+#   "in_process": worker threads of this instance run the action directly,
+#   skipping the queue, the extra request and its auth check. The tasks
+#   aren't retried, they are lost if the instance shuts down, and they
+#   only get CPU after the response when CPU is always allocated (Cloud
+#   Run), so use it there or for local development.
+TASK_BACKEND = "cloud_tasks"
+
+# Worker threads of the in_process backend.
+IN_PROCESS_WORKERS = 4
+
+LOCATION = "us-central1"
+QUEUE = "story-queue"
+
+# Maximum number of tasks created at once by run_as_background_tasks(),
+# shared by all requests of the instance.
+MAX_PARALLEL_ENQUEUES = 8
+enqueue_executor = ThreadPoolExecutor(max_workers=MAX_PARALLEL_ENQUEUES, thread_name_prefix="enqueue")
+
+# Cloud Tasks client and queue path, created once per instance by
+# get_tasks_client(), so every task after the first reuses the open
+# gRPC channel.
+tasks_client = None
+queue_path = None
+tasks_client_lock = threading.Lock()
+
+
+def get_tasks_client():
+    """Returns the Cloud Tasks client and the queue path, creating them on first use."""
+
+    global tasks_client, queue_path
+
+    with tasks_client_lock:
+        if tasks_client is None:
+            # imported here, most events never create a task
+            from google.cloud import tasks_v2
+
+            tasks_client = tasks_v2.CloudTasksClient()
+            queue_path = tasks_client.queue_path(PROJECT_ID, LOCATION, QUEUE)
+
+    return tasks_client, queue_path
+
+
 def run_as_background_task(action, thread_id, user_text, message_id_to_update):
-    """Creates a task in Google Cloud Tasks for the specified action."""
+    """Runs the action in the background, with the TASK_BACKEND.
+
+    Returns the name of the new task.
+    """
+
+    logging.info(f"run_as_background_task: {action}")
+
+    return get_task_backend().enqueue(action, thread_id, user_text, message_id_to_update)
+
+
+def run_as_background_tasks(tasks):
+    """Runs several actions in the background at once.
+
+    tasks is a list of (action, thread_id, user_text, message_id_to_update)
+    tuples. Returns the names of the new tasks, in the same order.
+    """
+
+    return get_task_backend().enqueue_many(tasks)
+
+
+class CloudTasksBackend:
+    """Creates a task in Google Cloud Tasks that posts the action back to handle_chat."""
+
+    def enqueue(self, action, thread_id, user_text, message_id_to_update):
+        tasks_client, parent = get_tasks_client()
+
+        task = _make_task(action, thread_id, user_text, message_id_to_update)
+        response = tasks_client.create_task(request={"parent": parent, "task": task})
+        return response.name
+
+    def enqueue_many(self, tasks):
+        """Creates the tasks concurrently, at most MAX_PARALLEL_ENQUEUES at a time.
+
+        Raises: the first error of any task, after all of them were attempted.
+        """
+
+        futures = [enqueue_executor.submit(self.enqueue, *task) for task in tasks]
+        wait(futures)
+
+        return [future.result() for future in futures]
+
 
-    tasks_client = tasks_v2.CloudTasksClient()
+class InProcessBackend:
+    """Runs actions on worker threads of this instance, see TASK_BACKEND."""
+
+    def __init__(self, max_workers=IN_PROCESS_WORKERS):
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="background")
+        self.task_numbers = itertools.count(1)
+
+    def enqueue(self, action, thread_id, user_text, message_id_to_update):
+        name = f"in-process-{next(self.task_numbers)}"
+        self.executor.submit(self._run, name, action, thread_id, user_text, message_id_to_update)
+        return name
+
+    def enqueue_many(self, tasks):
+        return [self.enqueue(*task) for task in tasks]
+
+    def _run(self, name, *task):
+        try:
+            run_background_action(*task)
+        except Exception:
+            logging.exception(f"background task {name} failed")
+
+
+task_backends = {
+    "cloud_tasks": CloudTasksBackend,
+    "in_process": InProcessBackend,
+}
+
+# The backend of TASK_BACKEND, created on first use by get_task_backend().
+task_backend = None
+task_backend_lock = threading.Lock()
+
+
+def get_task_backend():
+    """Returns the task backend of the instance, creating it on first use."""
+
+    global task_backend
+
+    with task_backend_lock:
+        if task_backend is None:
+            task_backend = task_backends[TASK_BACKEND]()
+
+    return task_backend
+
+
+def _make_task(action, thread_id, user_text, message_id_to_update):
+    """Returns the Cloud Tasks task that posts the action back to handle_chat."""
 
     payload = {
         "background_task" : True,
@@ -29,21 +161,15 @@ def run_as_background_task(action, thread_id, user_text, message_id_to_update):
         "message_id_to_update" : message_id_to_update
     }
 
-    logging.info(f"run_as_background_task: {action}")
-
     # Convert dict to JSON string
     payload = json.dumps(payload)
 
-    LOCATION = "us-central1"
-    QUEUE = "story-queue"
-
-    parent = tasks_client.queue_path(PROJECT_ID, LOCATION, QUEUE)
-
     converted_payload = payload.encode()
 
     task = {
         "http_request": {
-            "http_method": tasks_v2.HttpMethod.POST,
+            # by name, so building a task doesn't need tasks_v2
+            "http_method": "POST",
             "url": TRIGGER_URL,
             "headers": {"Content-type": "application/json"},
             "oidc_token": {
@@ -54,7 +180,7 @@ def run_as_background_task(action, thread_id, user_text, message_id_to_update):
         }
     }
 
-    response = tasks_client.create_task(request={"parent": parent, "task": task})
+    return task
 
 
 def process_background_task(request):
@@ -73,24 +199,42 @@ def process_background_task(request):
     thread_id = task_data.get("thread_id")
     user_text = task_data.get("user_text")
     message_id_to_update = task_data.get("message_id_to_update")
-    space_id = thread_id.split("-")[1]
-    space_name = f"spaces/{space_id}"
-    user_id = thread_id.split("-")[0]
-
-    # get api_key
-    try:
-        api_key = datastore_util.get_api_key(user_id)
-        openai.api_key = api_key
-    except:
-        from main import MY_API_KEY
-        openai.api_key = MY_API_KEY
-
 
-    if action == "process_story_message":
-        story_util.process_story_message(thread_id, user_text, message_id_to_update)
-    
-    elif action == "handle_story_command":
-        story_util.handle_story_command(thread_id, user_text, message_id_to_update)
+    run_background_action(action, thread_id, user_text, message_id_to_update)
     
     return {}
 
+
+# Handlers of background actions, which take (thread_id, user_text,
+# message_id_to_update, api_key).
+actions = router_util.Router("action")
+actions.add("process_story_message", story_util.process_story_message, needs_api_key=True)
+actions.add("handle_story_command", story_util.handle_story_command, needs_api_key=True)
+
+
+@actions.route("summarize_thread", needs_api_key=True)
+def summarize_thread(thread_id, user_text, message_id_to_update, api_key):
+    history_util.summarize_thread(thread_id, api_key)
+
+
+@datastore_util.with_request_context
+def run_background_action(action, thread_id, user_text, message_id_to_update):
+    """Runs a background action with the API key of the thread's user.
+
+    All Datastore calls of the action share one ndb context.
+    """
+
+    route = actions.get(action)
+
+    # get api_key, passed on instead of set on openai, since actions of
+    # several users can run at once
+    api_key = None
+    if route and route.needs_api_key:
+        user_id = thread_id.split("-")[0]
+        try:
+            api_key = datastore_util.get_api_key(user_id)
+        except:
+            from main import MY_API_KEY
+            api_key = MY_API_KEY
+
+    actions.dispatch(action, thread_id, user_text, message_id_to_update, api_key)
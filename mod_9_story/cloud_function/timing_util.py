@@ -0,0 +1,31 @@
+import logging
+import time
+from contextlib import contextmanager
+
+
+class StageTimer:
+    """Records how long each stage of a pipeline takes.
+
+    Stages may run on different threads; log() writes one line with the
+    duration of every stage and the wall-clock total.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.stages = {}
+        self.started_at = time.perf_counter()
+
+    @contextmanager
+    def stage(self, stage_name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.stages[stage_name] = time.perf_counter() - start
+
+    def total(self):
+        return time.perf_counter() - self.started_at
+
+    def log(self):
+        breakdown = ", ".join(f"{name}={seconds:.2f}s" for name, seconds in self.stages.items())
+        logging.info(f"{self.name} timings: total={self.total():.2f}s, {breakdown}")
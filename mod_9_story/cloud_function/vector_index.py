@@ -0,0 +1,120 @@
+import json
+import os
+import threading
+import time
+
+import numpy as np
+
+# Maximum number of entries kept by default, the least recently used is evicted.
+MAX_ENTRIES = 1000
+
+
+class VectorIndex:
+    """Nearest neighbor lookup of answers by the embedding of their question.
+
+    Embeddings are normalized and stored as rows of one float32 matrix,
+    so a lookup is a single matrix-vector product. The matrix grows by
+    doubling up to max_entries rows, then the least recently used row is
+    replaced.
+    """
+
+    def __init__(self, max_entries=MAX_ENTRIES):
+        self.max_entries = max_entries
+        self.embeddings = None
+        self.last_used = np.zeros(0)
+        self.responses = []
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.responses)
+
+    def search(self, embedding, min_similarity=0.0):
+        """Returns (response, similarity) of the nearest entry, or (None, 0.0) if empty.
+
+        The entry only counts as used, for eviction, if its similarity is
+        at least min_similarity, so near misses don't keep entries around.
+        """
+
+        query = _normalize(embedding)
+
+        with self._lock:
+            size = len(self.responses)
+            if not size:
+                return None, 0.0
+
+            similarities = self.embeddings[:size] @ query
+            best = int(np.argmax(similarities))
+            if similarities[best] >= min_similarity:
+                self.last_used[best] = time.time()
+            return self.responses[best], float(similarities[best])
+
+    def add(self, embedding, response):
+        """Adds response for the question with embedding."""
+
+        row = _normalize(embedding)
+
+        with self._lock:
+            size = len(self.responses)
+
+            if self.embeddings is None:
+                self.embeddings = np.zeros((min(16, self.max_entries), len(row)), dtype=np.float32)
+                self.last_used = np.zeros(len(self.embeddings))
+
+            if size < self.max_entries:
+                if size == len(self.embeddings):
+                    self._grow(min(size * 2, self.max_entries))
+                index = size
+                self.responses.append(response)
+            else:
+                index = int(np.argmin(self.last_used))
+                self.responses[index] = response
+
+            self.embeddings[index] = row
+            self.last_used[index] = time.time()
+
+    def _grow(self, capacity):
+        embeddings = np.zeros((capacity, self.embeddings.shape[1]), dtype=np.float32)
+        embeddings[:len(self.embeddings)] = self.embeddings
+        last_used = np.zeros(capacity)
+        last_used[:len(self.last_used)] = self.last_used
+        self.embeddings, self.last_used = embeddings, last_used
+
+    def save(self, path):
+        """Saves the index to path, an .npz file."""
+
+        with self._lock:
+            size = len(self.responses)
+            if not size:
+                return
+
+            embeddings = self.embeddings[:size].copy()
+            last_used = self.last_used[:size].copy()
+            responses = json.dumps(self.responses)
+
+        # written next to path and renamed, so a reader never sees half a file
+        temp_path = path + ".tmp.npz"
+        np.savez(temp_path, embeddings=embeddings, last_used=last_used, responses=np.array(responses))
+        os.replace(temp_path, path)
+
+    @classmethod
+    def load(cls, path, max_entries=MAX_ENTRIES):
+        """Returns the index saved at path, keeping its max_entries most recently used entries."""
+
+        index = cls(max_entries)
+
+        with np.load(path) as data:
+            embeddings = data["embeddings"]
+            last_used = data["last_used"]
+            responses = json.loads(str(data["responses"]))
+
+        keep = np.argsort(last_used)[::-1][:max_entries]
+        index.embeddings = embeddings[keep].astype(np.float32)
+        index.last_used = last_used[keep]
+        index.responses = [responses[i] for i in keep]
+        return index
+
+
+def _normalize(embedding):
+    vector = np.asarray(embedding, dtype=np.float32)
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm else vector
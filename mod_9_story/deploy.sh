@@ -3,6 +3,9 @@
 # Break if error
 set -e
 
+# Datastore indexes used by the queries of the bot
+gcloud datastore indexes create index.yaml --quiet
+
 gcloud functions deploy chatgpt-bot \
 --region=us-central1 \
 --runtime=python311 \